@@ -17,8 +17,13 @@
 #
 
 import tkinter as tk # In python2 it's Tkinter
-from PIL import Image, ImageTk
-from itertools import count
+import abc
+import threading
+import queue
+import time
+from frame_cache import FrameSet, FrameStream, FrameCache
+from configuration import QConfiguration
+from timing_stats import LatenessStats
 from app_logger import AppLogger
 
 
@@ -27,22 +32,77 @@ the_app_logger = AppLogger("lumiclock")
 logger = the_app_logger.getAppLogger()
 
 
-class AnimatedGIFLabel(tk.Label):
+class GIFAnimator(metaclass=abc.ABCMeta):
     """
-        a label that displays images, and plays them if they are GIFs
+        Plays animated GIFs. This is a mixin for a Tk widget (or anything
+        with Tk's after, after_idle and after_cancel methods) that provides
+        show_frame() to put a frame on display.
         Adapted from the following SO article
         https://stackoverflow.com/questions/43770847/play-an-animated-gif-in-python-with-tkinter
     """
-    def __init__(self, parent, **args):
-        tk.Label.__init__(self, parent, **args)
+    # Number of Tk images created per callback during a background load
+    _photos_per_chunk = 8
+    # Expanded frames kept for compact (palette) frames when there is no memory budget
+    _compact_window = 3
+    # True if showing a changed image redraws only the part of it that
+    # changed (a canvas image item). A Label redraws all of its image, so
+    # delta updates would not save anything there.
+    _redraws_changed_region = False
+
+    def __init__(self):
         self.loc = 0
         self.im = None
         self.frames = []
         self.delay = 100
-        self.config(pady=0)
         self.running = False
         self.width = 128
         self.height = 128
+        # Streaming mode: frames are decoded on demand from _stream and only
+        # a window of upcoming frames is kept in _ring
+        self._stream = None
+        self._frame_count = 0
+        self._window = 0
+        self._ring = {}
+        self._spare = []
+        # Delta mode: one persistent Tk image on display. Each frame only
+        # replaces the region that differs from _shown, the frame in it.
+        # The region is pasted into _delta_patch and copied from there.
+        self._delta_photo = None
+        self._delta_patch = None
+        self._delta_on_display = False
+        self._shown = 0
+        # Pixels copied into the persistent image, for monitoring
+        self.delta_pixels = 0
+        # Background loading: results come back from the loader thread
+        # through _loaded and are matched against _load_generation
+        self._loaded = queue.Queue()
+        self._load_generation = 0
+        # Photos being built in chunks for a pending swap
+        self._pending = None
+        # Called when a background load has been swapped in
+        self._on_loaded = None
+        # Animation scheduling. Frame deadlines are on the monotonic clock.
+        self._frame_source = None
+        self._delay_override = None
+        self._deadline = 0.0
+        self._after_id = None
+        self._paused = False
+        self.frame_lateness = LatenessStats()
+
+    @abc.abstractmethod
+    def show_frame(self, photo):
+        """
+        Put a frame on display. Every class that uses the mixin provides this.
+        :param photo: The frame's PhotoImage or None to show nothing
+        :return:
+        """
+
+    def frame_updated(self):
+        """
+        Called when the image on display was changed in place
+        :return:
+        """
+        pass
 
     def load(self, im, delay=None):
         """
@@ -51,63 +111,432 @@ class AnimatedGIFLabel(tk.Label):
         :param delay: Override for delay duration.
         :return:
         """
-        self.im = im
-        if isinstance(im, str):
-            try:
-                im = Image.open(im)
-            except Exception as ex:
-                # Likely file not found
-                logger.error(ex)
-                logger.error(str(ex))
-                self.running = False
-                return
+        self._load_generation += 1
+        self._pending = None
+        self._on_loaded = None
+        frameset = self._open_frames(im)
+        if frameset is None:
+            self.running = False
+            return
 
-        self.frames = []
-        self.loc = 0
-        self.width, self.height = im.size
+        photos = None
+        if not self._is_streamed(frameset):
+            photos = self._make_photos(frameset, [], len(frameset))
+        self._install(im, frameset, photos, delay)
+
+    def load_async(self, im, delay=None, on_loaded=None):
+        """
+        Load an animated GIF without blocking the Tk thread. The GIF is
+        decoded on a loader thread and the current GIF keeps playing until
+        the new one is ready. Then the new frames replace the old ones in one step.
+        :param im: An image instance or the name of a GIF file.
+        :param delay: Override for delay duration.
+        :param on_loaded: Called (on the Tk thread) when the new GIF is on display
+        :return:
+        """
+        self._load_generation += 1
+        self._pending = None
+        self._on_loaded = on_loaded
+        loader = threading.Thread(target=self._load_worker,
+                                  args=(im, delay, self._load_generation),
+                                  name="GIFLoaderThread", daemon=True)
+        loader.start()
+        self.after(20, self._poll_loader)
+
+    def _load_worker(self, im, delay, generation):
+        """
+        Runs on the loader thread. Must not touch Tk.
+        :return:
+        """
+        self._loaded.put((generation, im, delay, self._open_frames(im)))
+
+    def _poll_loader(self):
+        """
+        Check for frames delivered by the loader thread
+        :return:
+        """
+        try:
+            generation, im, delay, frameset = self._loaded.get_nowait()
+        except queue.Empty:
+            self.after(20, self._poll_loader)
+            return
+
+        if generation != self._load_generation:
+            # A newer load superseded this one
+            if frameset is not None:
+                frameset.close()
+            return
+        if frameset is None:
+            return
 
+        if self._is_streamed(frameset):
+            self._install(im, frameset, None, delay)
+        else:
+            self._pending = (generation, im, delay, frameset, [])
+            self._build_photos()
+
+    def _build_photos(self):
+        """
+        Create the Tk images for a pending load a few frames at a time so the
+        current GIF and the clock keep running. When all of the images
+        are built, the new GIF is swapped in.
+        :return:
+        """
+        if self._pending is None or self._pending[0] != self._load_generation:
+            return
+        generation, im, delay, frameset, photos = self._pending
+        end = min(len(photos) + self._photos_per_chunk, len(frameset))
+        self._make_photos(frameset, photos, end)
+        if len(photos) < len(frameset):
+            self.after(1, self._build_photos)
+        else:
+            self._pending = None
+            self._install(im, frameset, photos, delay)
+
+    @staticmethod
+    def _make_photos(frameset, photos, end):
+        """
+        Create the Tk images for frames up to end. Identical frames share one image.
+        :param frameset: The frame source
+        :param photos: The Tk images created so far. The new ones are appended.
+        :param end: Frame number to stop at
+        :return: photos
+        """
+        from PIL import ImageTk
+        shared = {}
+        for i, photo in enumerate(photos):
+            shared.setdefault(frameset.stored_index(i), photo)
+        for i in range(len(photos), end):
+            stored = frameset.stored_index(i)
+            photo = shared.get(stored)
+            if photo is None:
+                photo = ImageTk.PhotoImage(frameset.image(i))
+                shared[stored] = photo
+            photos.append(photo)
+        return photos
+
+    def _open_frames(self, im):
+        """
+        Get the frame source for a GIF. Safe to call from the loader thread.
+        :param im: An image instance or the name of a GIF file.
+        :return: A FrameSet or FrameStream, or None if the GIF could not be opened
+        """
+        budget = QConfiguration.spinnermemory * 1024
         try:
-            for i in count(1):
-                self.frames.append(ImageTk.PhotoImage(im.copy()))
-                im.seek(i)
-        except EOFError:
-            pass
-        logger.debug("%d frames in GIF %s", len(self.frames), im)
+            if isinstance(im, str):
+                if QConfiguration.framecache:
+                    return FrameCache.load_frames(im)
+                from PIL import Image
+                if budget:
+                    return FrameStream(Image.open(im))
+                return FrameSet.from_image(Image.open(im))
+            elif budget:
+                return FrameStream(im)
+            return FrameSet.from_image(im)
+        except Exception as ex:
+            # Likely file not found
+            logger.error(ex)
+            logger.error(str(ex))
+        return None
+
+    def _is_streamed(self, frameset):
+        """
+        Frames are streamed when all of them would not fit in the memory
+        budget. Compact (palette) frames are always streamed, so they
+        are expanded only when they are about to be shown.
+        :param frameset: The frame source
+        :return: True if the frames should be streamed
+        """
+        if QConfiguration.compactframes and frameset.mode == "P":
+            return True
+        budget = QConfiguration.spinnermemory * 1024
+        return budget and (len(frameset) * frameset.display_frame_size) > budget
+
+    def _install(self, im, frameset, photos, delay):
+        """
+        Make a new set of frames the current GIF. Runs on the Tk thread.
+        :param im: An image instance or the name of a GIF file.
+        :param frameset: The frame source
+        :param photos: The Tk images for all frames or None to stream them from frameset
+        :param delay: Override for delay duration.
+        :return:
+        """
+        old_stream = self._stream
+        self.im = im
+        self.loc = 0
+        self._frame_source = frameset
+        self._delay_override = delay
+        self.width, self.height = frameset.size
+        self._frame_count = len(frameset)
+        self._ring = {}
+        self._spare = []
+        self._delta_photo = None
+        self._delta_patch = None
+        if (photos is None and self._redraws_changed_region and QConfiguration.deltaframes and
+                frameset.deltas is not None):
+            # Update the changed region of one image
+            from PIL import ImageTk
+            self.frames = None
+            self._stream = frameset
+            self._window = 0
+            self._delta_photo = ImageTk.PhotoImage(frameset.image(0))
+            self._delta_patch = ImageTk.PhotoImage(FrameSet.display_mode, frameset.size)
+            self._delta_on_display = False
+            self._shown = 0
+            logger.debug("Delta updates for %d frames in GIF %s", self._frame_count, im)
+            stored_size = frameset.memory_size
+            tk_size = 2 * frameset.display_frame_size
+        elif photos is None:
+            # Stream the frames through a ring buffer that fits the budget
+            budget = QConfiguration.spinnermemory * 1024
+            self.frames = None
+            self._stream = frameset
+            if budget:
+                self._window = max(2, int(budget / frameset.display_frame_size))
+            else:
+                self._window = self._compact_window
+            logger.debug("Streaming %d frames in GIF %s, %d frames resident",
+                         self._frame_count, im, self._window)
+            stored_size = frameset.memory_size
+            tk_size = self._window * frameset.display_frame_size
+        else:
+            self.frames = photos
+            self._stream = None
+            logger.debug("%d frames in GIF %s", len(self.frames), im)
+            stored_size = 0
+            tk_size = len({id(p) for p in photos}) * frameset.display_frame_size
+            # Tk has its own copy of every frame now
+            frameset.close()
+        logger.debug("Spinner memory for %s: %d KB %s frames, %d KB Tk images",
+                     im, int(stored_size / 1024), frameset.mode, int(tk_size / 1024))
 
         if not delay:
-            try:
-                self.delay = im.info['duration']
+            if frameset.delay:
+                self.delay = frameset.delay
                 logger.debug("GIF duration: %d", self.delay)
-            except:
+            else:
                 self.delay = 100
         else:
             self.delay = delay
         logger.debug("Delay: %d", self.delay)
 
-        if len(self.frames) == 1:
-            self.config(image=self.frames[0])
-        elif not self.running:
+        self.frame_lateness.reset()
+        if self._frame_count == 1 or self.running:
+            # Show the new GIF now. A running animation continues with it.
+            self._show(0)
+            self._deadline = time.monotonic() + (self._frame_delay(0) / 1000.0)
+        if self._frame_count > 1 and not self.running and not self._paused:
             # Only once!
-            self._next_frame()
             self.running = True
+            self._start_animation()
+
+        # The old frames are no longer on display
+        if old_stream is not None:
+            old_stream.close()
+
+        on_loaded, self._on_loaded = self._on_loaded, None
+        if on_loaded is not None:
+            on_loaded()
+
+    @property
+    def resident_frames(self):
+        """
+        The number of decoded frames held as Tk images. Safe to read from any thread.
+        """
+        if self._delta_photo is not None:
+            return 1
+        if self._stream is not None:
+            return len(self._ring)
+        return len(self.frames) if self.frames else 0
 
     def unload(self):
         """
         Remove the current GIF
         :return:
         """
-        self.config(image=None)
+        self.show_frame(None)
         self.frames = None
+        self._close_stream()
+
+    def _close_stream(self):
+        """
+        Release the streaming frame source and its ring buffer
+        :return:
+        """
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+        self._ring = {}
+        self._spare = []
+        self._delta_photo = None
+        self._delta_patch = None
+
+    def _show(self, index):
+        """
+        Put a frame on display. In delta mode only the region that differs
+        from the frame on display is copied into the persistent image.
+        :param index: Frame number
+        :return:
+        """
+        if self._delta_photo is None:
+            self.show_frame(self._get_frame(index))
+            return
+
+        if not self._delta_on_display:
+            # Showing a different image redraws all of it, so this is only done once
+            self.show_frame(self._delta_photo)
+            self._delta_on_display = True
+        box = self._stream.changed_box(self._shown, index)
+        self._shown = index
+        if box is None:
+            return
+        # The region goes into the top left corner of the patch image
+        self._delta_patch.paste(self._stream.image(index, box))
+        # "set" replaces the pixels, including transparent ones, instead of blending
+        self._delta_photo.tk.call(self._delta_photo, "copy", self._delta_patch,
+                                  "-from", 0, 0, box[2] - box[0], box[3] - box[1],
+                                  "-to", box[0], box[1], "-compositingrule", "set")
+        self.delta_pixels += (box[2] - box[0]) * (box[3] - box[1])
+        self.frame_updated()
+
+    def _get_frame(self, index):
+        """
+        Return the PhotoImage for a frame. In streaming mode the frame
+        is decoded if it is not already in the ring buffer.
+        :param index: Frame number
+        :return: PhotoImage
+        """
+        if self._stream is None:
+            return self.frames[index]
+
+        photo = self._ring.get(index)
+        if photo is None:
+            im = self._stream.image(index)
+            if self._spare:
+                # Recycle an evicted Tk image rather than creating a new one
+                photo = self._spare.pop()
+                photo.paste(im)
+            else:
+                from PIL import ImageTk
+                photo = ImageTk.PhotoImage(im)
+            self._ring[index] = photo
+        return photo
+
+    def _trim_ring(self):
+        """
+        Evict the frames that are outside of the window of upcoming
+        frames. The frame on display is always inside the window.
+        :return:
+        """
+        window = [(self.loc + i) % self._frame_count for i in range(self._window)]
+        for index in [i for i in self._ring if i not in window]:
+            self._spare.append(self._ring.pop(index))
+
+    def _prefetch(self):
+        """
+        Decode the upcoming frames that are not yet in the ring buffer.
+        Runs when Tk is idle, after the current frame is on screen.
+        :return:
+        """
+        if self._stream is None or self._delta_photo is not None:
+            return
+        for i in range(1, self._window):
+            self._get_frame((self.loc + i) % self._frame_count)
+
+    def pause(self):
+        """
+        Stop the animation, leaving the current frame on display
+        :return:
+        """
+        self._paused = True
+        if self._after_id is not None:
+            self.after_cancel(self._after_id)
+            self._after_id = None
+        self.running = False
+
+    def resume(self):
+        """
+        Restart a paused animation. Frame deadlines start over from now.
+        :return:
+        """
+        self._paused = False
+        if self._frame_count > 1 and not self.running:
+            self.running = True
+            self._start_animation()
+
+    def _frame_delay(self, index):
+        """
+        How long a frame stays on screen
+        :param index: Frame number
+        :return: Delay in ms
+        """
+        if self._delay_override:
+            return self._delay_override
+        duration = self._frame_source.duration(index)
+        if duration:
+            return duration
+        return self.delay
+
+    def _start_animation(self):
+        """
+        Show the current frame and start the frame deadline clock
+        :return:
+        """
+        self._show(self.loc)
+        self._deadline = time.monotonic() + (self._frame_delay(self.loc) / 1000.0)
+        if self._stream is not None and self._delta_photo is None:
+            self.after_idle(self._prefetch)
+        self._after_id = self.after(self._frame_delay(self.loc), self._next_frame)
 
     def _next_frame(self):
         """
-        Display the next frame of the animated GIF
+        Display the next frame of the animated GIF. Frames are shown at
+        fixed deadlines so that late callbacks do not accumulate as drift.
+        When a callback is so late that a frame's whole duration has passed,
+        that frame is skipped.
         :return:
         """
-        if self.frames:
-            self.loc += 1
-            self.loc %= len(self.frames)
-            self.config(image=self.frames[self.loc])
-            self.after(self.delay, self._next_frame)
-        else:
+        self._after_id = None
+        if not (self.frames or self._stream is not None):
             self.running = False
+            return
+
+        now = time.monotonic()
+        if now < self._deadline:
+            # Too early (for example, a new GIF was swapped in)
+            self._after_id = self.after(max(1, int((self._deadline - now) * 1000)), self._next_frame)
+            return
+
+        lateness = now - self._deadline
+        if lateness > (self._frame_count * self._frame_delay(self.loc) / 1000.0):
+            # Far behind (e.g. the system was suspended). Start over from now.
+            self._deadline = now
+
+        skipped = 0
+        self.loc = (self.loc + 1) % self._frame_count
+        next_deadline = self._deadline + (self._frame_delay(self.loc) / 1000.0)
+        while next_deadline <= now:
+            skipped += 1
+            self.loc = (self.loc + 1) % self._frame_count
+            next_deadline += self._frame_delay(self.loc) / 1000.0
+        self.frame_lateness.record(lateness * 1000.0, skipped)
+        self._deadline = next_deadline
+
+        self._show(self.loc)
+        if self._stream is not None and self._delta_photo is None:
+            self._trim_ring()
+            self.after_idle(self._prefetch)
+        self._after_id = self.after(max(1, int((next_deadline - time.monotonic()) * 1000)), self._next_frame)
+
+
+class AnimatedGIFLabel(GIFAnimator, tk.Label):
+    """
+        a label that displays images, and plays them if they are GIFs
+    """
+    def __init__(self, parent, **args):
+        tk.Label.__init__(self, parent, **args)
+        GIFAnimator.__init__(self)
+        self.config(pady=0)
+
+    def show_frame(self, photo):
+        self.config(image=photo)
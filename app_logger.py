@@ -18,11 +18,127 @@
 import logging
 import logging.handlers
 import os
+import queue
+import time
+import threading
+from collections import deque
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler for a bounded queue. When the queue is full the record
+    is dropped (and counted) instead of blocking the logging thread.
+    """
+    def __init__(self, log_queue):
+        logging.handlers.QueueHandler.__init__(self, log_queue)
+        self.dropped = 0
+        self._unreported = 0
+
+    def enqueue(self, record):
+        try:
+            if self._unreported:
+                # Tell the log how many records were lost
+                self.queue.put_nowait(logging.makeLogRecord({
+                    "name": record.name, "levelno": logging.WARNING, "levelname": "WARNING",
+                    "module": "app_logger",
+                    "msg": "{0} log records dropped (log queue full)".format(self._unreported)}))
+                self._unreported = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self._unreported += 1
+
+
+class RingBufferHandler(logging.Handler):
+    """
+    Keeps the most recent log lines in memory and writes records to the
+    target (file) handler in batches: when the flush interval has passed,
+    when a warning or error is logged, or when the batch gets as large as the
+    ring. A timer thread writes a batch that has waited for the flush interval
+    when no new record arrives to do it. The ring can be dumped to a file on demand.
+    """
+    def __init__(self, target, capacity=1000, flush_interval=60.0, flush_level=logging.WARNING):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.setFormatter(target.formatter)
+        self.flush_interval = flush_interval
+        self.flush_level = flush_level
+        # Formatted lines. Strings are far smaller than LogRecords.
+        self._ring = deque(maxlen=capacity)
+        # Records waiting to be written to the target
+        self._batch = []
+        self._last_flush = time.monotonic()
+        # Counters for monitoring
+        self.flushes = 0
+        self._closing = threading.Event()
+        if flush_interval > 0:
+            threading.Thread(target=self._flush_timer, name="LogFlushThread", daemon=True).start()
+
+    def emit(self, record):
+        self._ring.append(self.format(record))
+        self._batch.append(record)
+        if record.levelno >= self.flush_level or \
+                len(self._batch) >= self._ring.maxlen or \
+                (time.monotonic() - self._last_flush) >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the pending batch to the target handler
+        """
+        # The lock is held while writing so that batches written by
+        # the timer thread and by emit stay in order
+        self.acquire()
+        try:
+            batch = self._batch
+            self._batch = []
+            self._last_flush = time.monotonic()
+            if batch:
+                for record in batch:
+                    self.target.handle(record)
+                self.target.flush()
+                self.flushes += 1
+        finally:
+            self.release()
+
+    def _flush_timer(self):
+        """
+        Runs on the flush thread. Flushes whenever flush_interval has
+        passed since the last flush, however that flush happened.
+        """
+        while not self._closing.wait(max(0.0, self._last_flush + self.flush_interval - time.monotonic())):
+            if (time.monotonic() - self._last_flush) >= self.flush_interval:
+                self.flush()
+
+    def dump(self, file_path):
+        """
+        Write the lines in the ring to a file
+        :param file_path: Full path of the dump file
+        :return: Number of lines written
+        """
+        self.acquire()
+        try:
+            lines = list(self._ring)
+        finally:
+            self.release()
+        with open(file_path, "w") as df:
+            for line in lines:
+                df.write(line)
+                df.write("\n")
+        return len(lines)
+
+    def close(self):
+        self._closing.set()
+        self.flush()
+        self.target.close()
+        logging.Handler.close(self)
 
 
 class AppLogger:
     # All of the created loggers
     logger_list = []
+    # Async logging listeners by logname
+    _listeners = {}
 
     def __init__(self, logname):
         self.logger = None
@@ -59,7 +175,8 @@ class AppLogger:
             if not os.path.exists(file_path):
                 os.makedirs(file_path)
 
-            fh = logging.handlers.TimedRotatingFileHandler(logfile, when='midnight', backupCount=3)
+            fh = logging.handlers.TimedRotatingFileHandler(logfile, when='midnight', backupCount=3,
+                                                           delay=True)
             fh.setFormatter(formatter)
             self.logger.addHandler(fh)
             self.logger.debug("New logger %s created: %s", logname, str(self.logger))
@@ -100,7 +217,107 @@ class AppLogger:
         self.logger.setLevel(loglevel_setting)
         self.logger.debug("Log level set to %s", loglevel)
 
+    def set_async_logging(self, enabled, queue_size=1000):
+        """
+        Move the file and console handlers behind a queue. Logging calls only
+        enqueue the record and a single listener thread does the I/O. When
+        the queue is full records are dropped and counted.
+        :param enabled: True for asynchronous logging
+        :param queue_size: Maximum number of records waiting to be written
+        :return: None
+        """
+        name = self.logger.name
+        if enabled == (name in AppLogger._listeners):
+            return
+
+        if enabled:
+            handlers = list(self.logger.handlers)
+            queue_handler = DroppingQueueHandler(queue.Queue(maxsize=queue_size))
+            listener = logging.handlers.QueueListener(queue_handler.queue, *handlers,
+                                                      respect_handler_level=True)
+            for h in handlers:
+                self.logger.removeHandler(h)
+            self.logger.addHandler(queue_handler)
+            listener.start()
+            AppLogger._listeners[name] = (listener, queue_handler)
+            self.logger.debug("Asynchronous logging enabled, queue size %d", queue_size)
+        else:
+            listener, queue_handler = AppLogger._listeners.pop(name)
+            self.logger.removeHandler(queue_handler)
+            # Writes everything still in the queue
+            listener.stop()
+            for h in listener.handlers:
+                self.logger.addHandler(h)
+            self.logger.debug("Asynchronous logging disabled")
+
+    def set_ring_buffer(self, capacity, flush_interval):
+        """
+        Put the log file handler behind an in-memory ring buffer. Log records are
+        written to the file in batches (or immediately for warnings and errors).
+        This must be called before set_async_logging.
+        :param capacity: Number of recent log lines kept in memory (0 to disable)
+        :param flush_interval: Maximum seconds between batch writes
+        :return: None
+        """
+        if not capacity:
+            return
+        for h in list(self.logger.handlers):
+            if isinstance(h, logging.handlers.TimedRotatingFileHandler):
+                ring = RingBufferHandler(h, capacity=capacity, flush_interval=flush_interval)
+                self.logger.removeHandler(h)
+                self.logger.addHandler(ring)
+                self.logger.debug("Log ring buffer enabled, %d lines, flush every %d seconds",
+                                  capacity, flush_interval)
+
+    def _ring_buffer(self):
+        """
+        :return: The ring buffer handler (which may be behind the async queue) or None
+        """
+        handlers = list(self.logger.handlers)
+        if self.logger.name in AppLogger._listeners:
+            handlers += list(AppLogger._listeners[self.logger.name][0].handlers)
+        for h in handlers:
+            if isinstance(h, RingBufferHandler):
+                return h
+        return None
+
+    def dump_log_buffer(self, file_path=None):
+        """
+        Write the recent log lines kept in memory to a file
+        :param file_path: Full path of the dump file. The default is a time stamped
+        file next to the log file.
+        :return: The path of the dump file or None if there is no ring buffer
+        """
+        ring = self._ring_buffer()
+        if ring is None:
+            return None
+        if file_path is None:
+            file_path = "{0}-dump-{1}.log".format(os.path.splitext(ring.target.baseFilename)[0],
+                                                  time.strftime("%Y%m%d-%H%M%S"))
+        count = ring.dump(file_path)
+        self.logger.info("Dumped %d log lines to %s", count, file_path)
+        return file_path
+
+    def log_flushes(self):
+        """
+        :return: The number of batches the ring buffer has written to the
+        log file or None if there is no ring buffer
+        """
+        ring = self._ring_buffer()
+        return ring.flushes if ring is not None else None
+
+    def dropped_records(self):
+        """
+        :return: The number of records dropped because the log queue was full
+        """
+        if self.logger.name in AppLogger._listeners:
+            return AppLogger._listeners[self.logger.name][1].dropped
+        return 0
+
     # Controlled logging shutdown
     def Shutdown(self):
         self.getAppLogger().debug("Logging shutdown")
+        for listener, queue_handler in AppLogger._listeners.values():
+            listener.stop()
+        AppLogger._listeners = {}
         logging.shutdown()
@@ -0,0 +1,131 @@
+# -*- coding: UTF-8 -*-
+#
+# Single canvas clock display
+# Copyright © 2018, 2019  Dave Hocker (email: athomex10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# In compositor mode the clock, the spinner and the debug overlay are
+# items on one canvas instead of three placed widgets. Changing an item
+# makes Tk redraw only the area the item covers (for an image that is
+# changed in place, only the changed part of the image), rather than
+# reconfiguring and redrawing a whole widget.
+#
+
+import tkinter as tk # In python2 it's Tkinter
+from animated_gif_label import GIFAnimator
+from timing_stats import RateCounter
+from app_logger import AppLogger
+
+
+# Logger init
+the_app_logger = AppLogger("lumiclock")
+logger = the_app_logger.getAppLogger()
+
+
+class Compositor(tk.Canvas):
+    """
+    The canvas that everything is drawn on. Item changes go through
+    update_item and move_item so that changes that would not alter
+    anything are skipped and actual redraws are counted.
+    """
+    def __init__(self, parent, **args):
+        tk.Canvas.__init__(self, parent, bg='black', highlightthickness=0, borderwidth=0, **args)
+        # The options last set on each item
+        self._item_options = {}
+        # Item changes that cause Tk to redraw part of the canvas
+        self.redraws = RateCounter()
+
+    def update_item(self, item, **options):
+        """
+        Change the options of a canvas item. Options that already
+        have the requested value are not sent to Tk.
+        :param item: Canvas item id
+        :param options: Item options (text, image, fill, font, state...)
+        :return: True if the item changed
+        """
+        current = self._item_options.setdefault(item, {})
+        changed = {}
+        for key, value in options.items():
+            if key not in current or current[key] != value:
+                changed[key] = value
+        if not changed:
+            return False
+        self.itemconfigure(item, **changed)
+        current.update(changed)
+        self.redraws.count()
+        return True
+
+    def move_item(self, item, x, y):
+        """
+        Move a canvas item
+        :param item: Canvas item id
+        :param x: New x coordinate
+        :param y: New y coordinate
+        :return: None
+        """
+        self.coords(item, x, y)
+        self.redraws.count()
+
+    def image_changed(self):
+        """
+        Count a redraw caused by an image that was changed in place
+        (for example, the glyph clock face)
+        :return: None
+        """
+        self.redraws.count()
+
+
+class CanvasGIFItem(GIFAnimator):
+    """
+    An animated GIF played in a compositor image item. It has the same
+    interface as AnimatedGIFLabel, except that it is positioned with place_at.
+    """
+    # Tk redraws only the changed part of a canvas image, so frames
+    # can be shown as delta updates
+    _redraws_changed_region = True
+
+    def __init__(self, compositor):
+        """
+        :param compositor: The Compositor to draw on
+        """
+        GIFAnimator.__init__(self)
+        self.compositor = compositor
+        self.item = compositor.create_image(0, 0, anchor=tk.CENTER)
+
+    def show_frame(self, photo):
+        if photo is not None:
+            self.compositor.update_item(self.item, image=photo)
+
+    def frame_updated(self):
+        self.compositor.image_changed()
+
+    def place_at(self, x, y):
+        """
+        Center the GIF on a point
+        :param x: Canvas x coordinate
+        :param y: Canvas y coordinate
+        :return: None
+        """
+        self.compositor.move_item(self.item, x, y)
+
+    # The animation is scheduled on the compositor's Tk event loop
+
+    def after(self, ms, func=None, *args):
+        return self.compositor.after(ms, func, *args)
+
+    def after_idle(self, func, *args):
+        return self.compositor.after_idle(func, *args)
+
+    def after_cancel(self, after_id):
+        self.compositor.after_cancel(after_id)
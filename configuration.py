@@ -19,6 +19,7 @@ import os
 import os.path
 import inspect
 import json
+import threading
 from app_logger import AppLogger
 
 
@@ -39,15 +40,53 @@ class QConfiguration:
     spinner = "spiral_triangles.gif"
     color = "#EC3818"
     loglevel = "debug"
+    # Write log records on a background thread
+    asynclogging = True
+    logqueuesize = 1000
+    # Recent log lines kept in memory (0 = off) and how often they are written to the log file
+    logbuffer = 1000
+    logflushinterval = 60
     backlight = 128
+    # Backlight control: sysfs (direct) or rpi_backlight (package)
+    backlightbackend = "sysfs"
+    backlightroot = "/sys/class/backlight"
     pirsensor = False
     timeout = 10 * 60
     timein = 10
     debugdisplay = True
     # GPIO 18 or BCM pin 12
     pirpin = 12
+    # PIR sensing mode: poll (once a second) or edge (GPIO edge detection)
+    pirmode = "poll"
+    # Cache decoded spinner frames on disk
+    framecache = True
+    # Memory budget in KB for decoded spinner frames (0 = no limit)
+    spinnermemory = 0
+    # Keep spinner frames as palette indexes and expand them when shown
+    compactframes = True
+    # Update only the changed region of the spinner image for each frame (compositor only)
+    deltaframes = True
+    # Stop rendering while the display is off
+    powersave = True
+    # Draw the clock from pre-rendered digit images
+    glyphatlas = False
+    # Draw everything on one canvas instead of separate widgets
+    compositor = False
+    # Measure Tk callbacks and log a summary every instrumentationreport seconds
+    instrumentation = False
+    instrumentationreport = 300
+    # Port of the status endpoint on localhost (0 = off)
+    statusport = 0
     cwd = ""
     conf_exists = False
+    # Modification time of the configuration file when it was last read or written
+    conf_mtime = None
+    # Save setting changes automatically (after a quiet period)
+    autosave = False
+    # Deferred save. Changes within this many seconds are written together.
+    _save_delay = 5.0
+    _save_timer = None
+    _save_lock = threading.Lock()
 
     @classmethod
     def load(cls):
@@ -68,58 +107,8 @@ class QConfiguration:
 
         # Read conf file
         try:
-            cf = open(cls.full_file_path, "r")
-            cfj = json.loads(cf.read())
-            if "loglevel" in cfj:
-                cls.loglevel = cfj["loglevel"]
-            if "font" in cfj:
-                cls.font = cfj["font"]
-            if "fontsize" in cfj:
-                try:
-                    cls.fontsize = int(cfj["fontsize"])
-                except:
-                    logger.error("Invalid fontsize value: %s", cfj["fontsize"])
-            if "spinner" in cfj:
-                cls.spinner = cfj["spinner"]
-            if "color" in cfj:
-                cls.color = cfj["color"]
-            if "pirsensor" in cfj:
-                if cfj["pirsensor"].lower() in ["true", "on", "1"]:
-                    cls.pirsensor = True
-                else:
-                    cls.pirsensor = False
-            if "timeout" in cfj:
-                try:
-                    cls.timeout = int(cfj["timeout"])
-                except:
-                    logger.error("Invalid configuration value for timeout: %s", cfj["timeout"])
-            if "timein" in cfj:
-                try:
-                    cls.timein = int(cfj["timein"])
-                except:
-                    logger.error("Invalid configuration value for timein: %s", cfj["timein"])
-            if "debugdisplay" in cfj:
-                cls.debugdisplay = cfj["debugdisplay"].lower() in ["true", "on", "1"]
-            if "backlight" in cfj:
-                try:
-                    cls.backlight = int(cfj["backlight"])
-                    # Enforce 0 <= backlight <= 255
-                    cls.backlight = min(cls.backlight, 255)
-                    cls.backlight = max(cls.backlight, 0)
-                except:
-                    logger.error("Invalid configuration value for backlight: %s", cfj["backlight"])
-            if "pirpin" in cfj:
-                try:
-                    pin = int(cfj["pirpin"])
-                    # Enforce 3 <= pirpin <= 40
-                    if pin < 3 or pin > 40:
-                        raise ValueError("Invalid configuration value for pirpin: %s", str(cfj["pirpin"]))
-                    cls.pirpin = pin
-                except ValueError as ex:
-                    logger.error(ex)
-                except:
-                    logger.error("Invalid configuration value for backlight: %s", cfj["backlight"])
-            cf.close()
+            cfj = cls._read_file()
+            cls._apply_settings(cfj)
             cls.conf_exists = True
         except FileNotFoundError as ex:
             logger.error("%s was not found", cls.full_file_path)
@@ -138,29 +127,261 @@ class QConfiguration:
         # The logger defaults to debug level logging.
         # This sets the log level to whatever default was set above.
         the_app_logger.set_log_level(cls.loglevel)
+        the_app_logger.set_ring_buffer(cls.logbuffer, cls.logflushinterval)
+        the_app_logger.set_async_logging(cls.asynclogging, cls.logqueuesize)
 
         # Dump the config for debugging purposes
         QConfiguration.log_dump()
 
+    @classmethod
+    def _read_file(cls):
+        """
+        Read the configuration file and note its modification time. The time
+        is noted before the file is parsed, so a file that cannot be parsed
+        is not read again until it changes.
+        :return: The JSON contents as a dict
+        """
+        cls.conf_mtime = os.stat(cls.full_file_path).st_mtime_ns
+        cf = open(cls.full_file_path, "r")
+        text = cf.read()
+        cf.close()
+        return json.loads(text)
+
+    @classmethod
+    def _apply_settings(cls, cfj):
+        """
+        Set the configuration properties from the contents of a configuration file
+        :param cfj: The JSON contents of the configuration file as a dict
+        :return: None
+        """
+        if "autosave" in cfj:
+            cls.autosave = cfj["autosave"].lower() in ["true", "on", "1"]
+        if "loglevel" in cfj:
+            cls.loglevel = cfj["loglevel"]
+        if "font" in cfj:
+            cls.font = cfj["font"]
+        if "fontsize" in cfj:
+            try:
+                cls.fontsize = int(cfj["fontsize"])
+            except:
+                logger.error("Invalid fontsize value: %s", cfj["fontsize"])
+        if "spinner" in cfj:
+            cls.spinner = cfj["spinner"]
+        if "color" in cfj:
+            cls.color = cfj["color"]
+        if "pirsensor" in cfj:
+            if cfj["pirsensor"].lower() in ["true", "on", "1"]:
+                cls.pirsensor = True
+            else:
+                cls.pirsensor = False
+        if "timeout" in cfj:
+            try:
+                cls.timeout = int(cfj["timeout"])
+            except:
+                logger.error("Invalid configuration value for timeout: %s", cfj["timeout"])
+        if "timein" in cfj:
+            try:
+                cls.timein = int(cfj["timein"])
+            except:
+                logger.error("Invalid configuration value for timein: %s", cfj["timein"])
+        if "debugdisplay" in cfj:
+            cls.debugdisplay = cfj["debugdisplay"].lower() in ["true", "on", "1"]
+        if "backlight" in cfj:
+            try:
+                cls.backlight = int(cfj["backlight"])
+                # Enforce 0 <= backlight <= 255
+                cls.backlight = min(cls.backlight, 255)
+                cls.backlight = max(cls.backlight, 0)
+            except:
+                logger.error("Invalid configuration value for backlight: %s", cfj["backlight"])
+        if "pirpin" in cfj:
+            try:
+                pin = int(cfj["pirpin"])
+                # Enforce 3 <= pirpin <= 40
+                if pin < 3 or pin > 40:
+                    raise ValueError("Invalid configuration value for pirpin: %s", str(cfj["pirpin"]))
+                cls.pirpin = pin
+            except ValueError as ex:
+                logger.error(ex)
+            except:
+                logger.error("Invalid configuration value for backlight: %s", cfj["backlight"])
+        if "framecache" in cfj:
+            cls.framecache = cfj["framecache"].lower() in ["true", "on", "1"]
+        if "spinnermemory" in cfj:
+            try:
+                cls.spinnermemory = max(int(cfj["spinnermemory"]), 0)
+            except:
+                logger.error("Invalid configuration value for spinnermemory: %s", cfj["spinnermemory"])
+        if "compactframes" in cfj:
+            cls.compactframes = cfj["compactframes"].lower() in ["true", "on", "1"]
+        if "deltaframes" in cfj:
+            cls.deltaframes = cfj["deltaframes"].lower() in ["true", "on", "1"]
+        if "powersave" in cfj:
+            cls.powersave = cfj["powersave"].lower() in ["true", "on", "1"]
+        if "glyphatlas" in cfj:
+            cls.glyphatlas = cfj["glyphatlas"].lower() in ["true", "on", "1"]
+        if "compositor" in cfj:
+            cls.compositor = cfj["compositor"].lower() in ["true", "on", "1"]
+        if "instrumentation" in cfj:
+            cls.instrumentation = cfj["instrumentation"].lower() in ["true", "on", "1"]
+        if "instrumentationreport" in cfj:
+            try:
+                cls.instrumentationreport = max(int(cfj["instrumentationreport"]), 0)
+            except:
+                logger.error("Invalid configuration value for instrumentationreport: %s",
+                             cfj["instrumentationreport"])
+        if "statusport" in cfj:
+            try:
+                port = int(cfj["statusport"])
+                if port < 0 or port > 65535:
+                    raise ValueError("statusport must be 0-65535")
+                cls.statusport = port
+            except ValueError as ex:
+                logger.error(ex)
+            except:
+                logger.error("Invalid configuration value for statusport: %s", cfj["statusport"])
+        if "pirmode" in cfj:
+            if cfj["pirmode"].lower() in ["poll", "edge"]:
+                cls.pirmode = cfj["pirmode"].lower()
+            else:
+                logger.error("Invalid configuration value for pirmode: %s", cfj["pirmode"])
+        if "backlightbackend" in cfj:
+            if cfj["backlightbackend"].lower() in ["sysfs", "rpi_backlight"]:
+                cls.backlightbackend = cfj["backlightbackend"].lower()
+            else:
+                logger.error("Invalid configuration value for backlightbackend: %s",
+                             cfj["backlightbackend"])
+        if "backlightroot" in cfj:
+            cls.backlightroot = cfj["backlightroot"]
+        if "asynclogging" in cfj:
+            cls.asynclogging = cfj["asynclogging"].lower() in ["true", "on", "1"]
+        if "logqueuesize" in cfj:
+            try:
+                cls.logqueuesize = max(int(cfj["logqueuesize"]), 1)
+            except:
+                logger.error("Invalid configuration value for logqueuesize: %s", cfj["logqueuesize"])
+        if "logbuffer" in cfj:
+            try:
+                cls.logbuffer = max(int(cfj["logbuffer"]), 0)
+            except:
+                logger.error("Invalid configuration value for logbuffer: %s", cfj["logbuffer"])
+        if "logflushinterval" in cfj:
+            try:
+                cls.logflushinterval = max(int(cfj["logflushinterval"]), 0)
+            except:
+                logger.error("Invalid configuration value for logflushinterval: %s",
+                             cfj["logflushinterval"])
+
+    @classmethod
+    def reload(cls):
+        """
+        Read the configuration file again if it has changed since it was
+        last read or written. This is cheap enough to call from a timer.
+        :return: A dict of the settings that changed and their new values
+        (see to_dict). It is empty if nothing changed.
+        """
+        try:
+            mtime = os.stat(cls.full_file_path).st_mtime_ns
+        except FileNotFoundError:
+            return {}
+        if mtime == cls.conf_mtime:
+            return {}
+
+        before = QConfiguration.to_dict()
+        try:
+            cfj = cls._read_file()
+        except Exception as ex:
+            # Reported once. The file is read again when it changes.
+            logger.error("An exception occurred while attempting to reload %s", cls.full_file_path)
+            logger.error(str(ex))
+            return {}
+        cls._apply_settings(cfj)
+        after = QConfiguration.to_dict()
+
+        changes = {}
+        for key, value in after.items():
+            if before[key] != value:
+                changes[key] = value
+        logger.debug("Configuration reloaded, changed: %s", changes)
+
+        if "loglevel" in changes:
+            the_app_logger.set_log_level(cls.loglevel)
+        if "asynclogging" in changes or "logqueuesize" in changes:
+            the_app_logger.set_async_logging(False)
+            the_app_logger.set_async_logging(cls.asynclogging, cls.logqueuesize)
+        return changes
+
     @classmethod
     def save(cls):
         """
-        Save configuraton back to iex.conf
+        Save configuraton back to lumiclock.conf. The file is written under a
+        temporary name, flushed to storage and then renamed over the old file,
+        so a power failure leaves either the old or the new file.
         :return:
         """
+        with cls._save_lock:
+            if cls._save_timer is not None:
+                # This save covers any pending deferred save
+                cls._save_timer.cancel()
+                cls._save_timer = None
 
-        # Make sure folders exist
-        if not os.path.exists(cls.file_path):
-            os.makedirs(cls.file_path)
+            # Make sure folders exist
+            if not os.path.exists(cls.file_path):
+                os.makedirs(cls.file_path)
 
-        conf = QConfiguration.to_dict()
+            conf = QConfiguration.to_dict()
 
-        logger.debug("Saving configuration to %s", cls.full_file_path)
-        cf = open(cls.full_file_path, "w")
-        json.dump(conf, cf, indent=4)
-        cf.close()
+            logger.debug("Saving configuration to %s", cls.full_file_path)
+            temp_file_path = cls.full_file_path + ".tmp"
+            cf = open(temp_file_path, "w")
+            json.dump(conf, cf, indent=4)
+            cf.flush()
+            os.fsync(cf.fileno())
+            cf.close()
+            os.replace(temp_file_path, cls.full_file_path)
+            if os.name == "posix":
+                # Make the rename itself durable
+                dir_fd = os.open(cls.file_path, os.O_RDONLY)
+                try:
+                    os.fsync(dir_fd)
+                finally:
+                    os.close(dir_fd)
+
+            cls.conf_exists = True
+            # Our own write is not a change to reload
+            cls.conf_mtime = os.stat(cls.full_file_path).st_mtime_ns
+
+    @classmethod
+    def save_later(cls):
+        """
+        Save the configuration after a quiet period. Each call restarts the
+        wait, so a burst of setting changes results in one write.
+        :return:
+        """
+        with cls._save_lock:
+            if cls._save_timer is not None:
+                cls._save_timer.cancel()
+            cls._save_timer = threading.Timer(cls._save_delay, cls.save)
+            cls._save_timer.daemon = True
+            cls._save_timer.start()
+
+    @classmethod
+    def flush_pending_save(cls):
+        """
+        Write a deferred save now, if there is one
+        :return:
+        """
+        if cls._save_timer is not None:
+            cls.save()
 
-        cls.conf_exists = True
+    @classmethod
+    def setting_changed(cls):
+        """
+        Called when a setting is changed from the user interface
+        :return:
+        """
+        if cls.autosave:
+            cls.save_later()
 
     @classmethod
     def log_dump(cls):
@@ -176,6 +397,7 @@ class QConfiguration:
         :return:
         """
         conf = {}
+        conf["autosave"] = str(cls.autosave)
         conf["loglevel"] = cls.loglevel
         conf["font"] = cls.font
         conf["color"] = cls.color
@@ -187,6 +409,23 @@ class QConfiguration:
         conf["fontsize"] = cls.fontsize
         conf["backlight"] = cls.backlight
         conf["pirpin"] = cls.pirpin
+        conf["framecache"] = str(cls.framecache)
+        conf["spinnermemory"] = cls.spinnermemory
+        conf["compactframes"] = str(cls.compactframes)
+        conf["deltaframes"] = str(cls.deltaframes)
+        conf["powersave"] = str(cls.powersave)
+        conf["glyphatlas"] = str(cls.glyphatlas)
+        conf["compositor"] = str(cls.compositor)
+        conf["instrumentation"] = str(cls.instrumentation)
+        conf["instrumentationreport"] = cls.instrumentationreport
+        conf["statusport"] = cls.statusport
+        conf["pirmode"] = cls.pirmode
+        conf["backlightbackend"] = cls.backlightbackend
+        conf["backlightroot"] = cls.backlightroot
+        conf["asynclogging"] = str(cls.asynclogging)
+        conf["logqueuesize"] = cls.logqueuesize
+        conf["logbuffer"] = cls.logbuffer
+        conf["logflushinterval"] = cls.logflushinterval
         return conf
 
     @classmethod
@@ -197,6 +436,3 @@ class QConfiguration:
         """
 
         return cls.conf_exists
-
-# Set up configuration
-QConfiguration.load()
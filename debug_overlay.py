@@ -0,0 +1,145 @@
+# -*- coding: UTF-8 -*-
+#
+# Debug overlay
+# Copyright © 2018, 2019  Dave Hocker (email: athomex10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# The overlay is made of fields. Each field has a data source (a function
+# that returns a value) and a function that turns the value into text.
+# On each refresh the sources are read, but a field's text is only rebuilt
+# when its value changed, and the display is only changed when the
+# resulting text is different.
+#
+
+from configuration import QConfiguration
+from app_logger import AppLogger
+
+
+# Logger init
+the_app_logger = AppLogger("lumiclock")
+logger = the_app_logger.getAppLogger()
+
+
+class _Field:
+    def __init__(self, line, source, render):
+        self.line = line
+        self.source = source
+        self.render = render
+        self.value = None
+        self.text = ""
+        self.valid = False
+
+
+class DebugOverlay:
+    """
+    Multi-line debug display built from registered data sources.
+    It refreshes on its own timer, independently of the clock.
+    """
+    _separator = " | "
+
+    def __init__(self, widget, show, refresh_ms=1000):
+        """
+        :param widget: Any Tk widget. Used to schedule refreshes.
+        :param show: Called with the new text when the overlay text changes
+        :param refresh_ms: Time between refreshes
+        """
+        self._widget = widget
+        self._show = show
+        self.refresh_ms = refresh_ms
+        self._fields = []
+        self._text = None
+        self._after_id = None
+        self._paused = False
+        # Counters for monitoring
+        self.refreshes = 0
+        self.renders = 0
+        self.updates = 0
+
+    def add_field(self, line, source, render):
+        """
+        Register a field. Fields are shown in the order they were added.
+        :param line: Line number (0 is the top line)
+        :param source: Function that returns the field's current value
+        :param render: Function that turns a value into the field's text
+        :return: None
+        """
+        self._fields.append(_Field(line, source, render))
+        self._invalidate()
+
+    def start(self):
+        """
+        Start refreshing
+        :return: None
+        """
+        self._paused = False
+        if self._after_id is None:
+            self._refresh_tick()
+
+    def pause(self):
+        """
+        Stop refreshing, leaving the current text on display
+        :return: None
+        """
+        self._paused = True
+        if self._after_id is not None:
+            self._widget.after_cancel(self._after_id)
+            self._after_id = None
+
+    def resume(self):
+        self.start()
+
+    def refresh(self):
+        """
+        Read the data sources and update the display if the text changed
+        :return: None
+        """
+        self.refreshes += 1
+        if not QConfiguration.debugdisplay:
+            # Forget the field values so that they are all
+            # rendered when the overlay is turned back on
+            self._invalidate()
+            self._set_text("")
+            return
+
+        lines = {}
+        for field in self._fields:
+            value = field.source()
+            if value is None:
+                # Source not available (for example, no PIR sensor)
+                continue
+            if not field.valid or value != field.value:
+                field.value = value
+                field.text = field.render(value)
+                field.valid = True
+                self.renders += 1
+            lines.setdefault(field.line, []).append(field.text)
+        text = "\n".join(self._separator.join(lines[line]) for line in sorted(lines))
+        self._set_text(text)
+
+    def _refresh_tick(self):
+        self._after_id = None
+        if self._paused:
+            return
+        self.refresh()
+        self._after_id = self._widget.after(self.refresh_ms, self._refresh_tick)
+
+    def _invalidate(self):
+        for field in self._fields:
+            field.valid = False
+
+    def _set_text(self, text):
+        if text != self._text:
+            self._text = text
+            self._show(text)
+            self.updates += 1
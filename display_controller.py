@@ -34,7 +34,10 @@
 import threading
 import subprocess
 import platform
-import rpi_backlight
+import time
+from event_queue import CoalescingQueue
+from configuration import QConfiguration
+from timing_stats import LatenessStats
 from app_logger import AppLogger
 
 # Logger init
@@ -61,11 +64,26 @@ class DisplayController:
 
     # Serializes access to the display
     _display_lock = threading.Lock()
-    _backlight_state = 0
+    # 1 = on, 0 = off, None = not known yet
+    _backlight_state = None
+    _brightness = None
+
+    # The actuator thread owns the display hardware once it is started.
+    # Until then, display commands run on the calling thread.
+    _actuator = None
 
     # A singleton instance of the backlight class
     _backlight = None
 
+    # Display capabilities, found by probe_display()
+    _probed = False
+    _hdmi_display = False
+    _hotplug_monitor = None
+
+    # Sensor events that arrive within this many seconds of each other are
+    # handled together, so a rapid off/on flip does not touch the display.
+    _settle_time = 0.5
+
     def __init__(self):
         """
         Class constructor.
@@ -73,21 +91,19 @@ class DisplayController:
             display off state.
         """
 
-        # This path needs to be determined based on machine/OS version
-        # This value works for RPi OS Desktop 64-bit aarch64.
-        # It will not work for 32-bit OSes.
-        if DisplayController._backlight is None:
-            backlight_path = DisplayController.get_backlight_path()
-            if backlight_path is None:
-                DisplayController._backlight = None
-            elif backlight_path != "":
-                DisplayController._backlight = rpi_backlight.Backlight(backlight_path)
-            elif backlight_path == "":
-                DisplayController._backlight = rpi_backlight.Backlight()
-            else:
-                logger.error("Could not resolve location of backlight")
+        if not DisplayController._probed:
+            DisplayController.probe_display()
 
         self._display_state = DisplayController.query_display_state()
+        if self._display_state == self._state_display_on:
+            DisplayController._backlight_state = 1
+        elif self._display_state == self._state_display_off:
+            DisplayController._backlight_state = 0
+
+        # Sensor events are queued by the sensor thread and
+        # handled on the display event thread
+        self._events = CoalescingQueue()
+        self._event_thread = None
 
     """
     The techniques used to manage diffrent displays was
@@ -120,14 +136,157 @@ class DisplayController:
             # Unknown state
             logger.debug("Undefined state %s", self._display_state)
 
+    def post_sensor_value(self, sensor_value):
+        """
+        Queue a change of the debounced sensor value. This is the sensor
+        thread's notify callback. It does not wait for the display.
+        :param sensor_value: The current debounced value of the PIR sensor
+        :return: None
+        """
+        self._events.put("sensor", sensor_value)
+
+    def start(self):
+        """
+        Start the thread that handles queued sensor events
+        and the display hotplug monitor
+        :return: None
+        """
+        self._event_thread = threading.Thread(target=self._run_events, name="DisplayEventThread",
+                                              daemon=True)
+        self._event_thread.start()
+        if DisplayController._actuator is None:
+            DisplayController._actuator = DisplayActuator()
+            DisplayController._actuator.start()
+        if DisplayController.is_raspberry_pi() and DisplayController._hotplug_monitor is None:
+            DisplayController._hotplug_monitor = DisplayHotplugMonitor()
+            DisplayController._hotplug_monitor.start()
+
+    def stop(self):
+        """
+        Stop the display event thread
+        :return: None
+        """
+        self._events.close()
+        if self._event_thread is not None:
+            self._event_thread.join()
+            self._event_thread = None
+        if DisplayController._hotplug_monitor is not None:
+            DisplayController._hotplug_monitor.terminate()
+            DisplayController._hotplug_monitor = None
+        if DisplayController._actuator is not None:
+            DisplayController._actuator.terminate()
+            DisplayController._actuator = None
+
+    def _run_events(self):
+        """
+        Display event thread. Waits for sensor events, lets rapid
+        changes settle and applies only the latest value.
+        :return: None
+        """
+        try:
+            while not self._events.closed:
+                events = self._events.get()
+                if "sensor" not in events:
+                    continue
+                # Let rapid flips settle. Later values replace earlier ones.
+                time.sleep(self._settle_time)
+                events.update(self._events.get(timeout=0))
+                self.set_display_state(events["sensor"])
+            logger.debug("Display event thread terminated")
+        except Exception as ex:
+            logger.error("Display event thread terminated by unhandled exception")
+            logger.error(ex)
+
     def get_display_state(self):
         return self._display_states[self._display_state]
 
-    @staticmethod
-    def is_hdmi_display():
+    @property
+    def events_posted(self):
+        """
+        Sensor events posted to the display controller
+        """
+        return self._events.posted
+
+    @property
+    def events_coalesced(self):
+        """
+        Sensor events replaced by a newer one before they were handled
+        """
+        return self._events.coalesced
+
+    @classmethod
+    def backlight_writes(cls):
+        """
+        Writes to the backlight (only the sysfs backend counts them)
+        :return: (writes, skipped writes) or None if they are not counted
+        """
+        backlight = cls._backlight
+        if backlight is None or not hasattr(backlight, "skipped_writes"):
+            return None
+        return backlight.writes, backlight.skipped_writes
+
+    @classmethod
+    def actuator(cls):
+        """
+        The display actuator, for monitoring its latency and
+        dropped and failed command counts
+        :return: The DisplayActuator or None if commands run on the caller's thread
+        """
+        return cls._actuator
+
+    @classmethod
+    def probe_display(cls):
+        """
+        Find out what kind of display is attached and set up the backlight.
+        This runs once at startup and again when the hotplug monitor sees
+        an HDMI event. Everything else uses the cached results.
+        :return: None
+        """
+        with cls._display_lock:
+            if cls._probed:
+                # A hotplugged display is in an unknown state. Forget what
+                # was last applied so the next commands are not dropped.
+                cls._backlight_state = None
+                cls._brightness = None
+            cls._hdmi_display = cls.is_raspberry_pi() and cls._probe_hdmi_display()
+
+            if cls._backlight is None and QConfiguration.backlightbackend == "sysfs":
+                # Native sysfs backend. The root can be a fake sysfs tree.
+                from sysfs_backlight import SysfsBacklight
+                cls._backlight = SysfsBacklight.discover(QConfiguration.backlightroot)
+
+            # This path needs to be determined based on machine/OS version
+            # This value works for RPi OS Desktop 64-bit aarch64.
+            # It will not work for 32-bit OSes.
+            if cls._backlight is None:
+                backlight_path = cls.get_backlight_path()
+                if backlight_path is None:
+                    cls._backlight = None
+                else:
+                    import rpi_backlight
+                    if backlight_path != "":
+                        cls._backlight = rpi_backlight.Backlight(backlight_path)
+                    else:
+                        cls._backlight = rpi_backlight.Backlight()
+
+            cls._probed = True
+        logger.debug("Display probed: %s", "HDMI" if cls._hdmi_display else "touchscreen/none")
+
+    @classmethod
+    def is_hdmi_display(cls):
         """
         Answers the question: Is the current display HDMI?
         Otherwise, it is assumed to be the RPi 7" touchscreen.
+        The answer comes from the last display probe.
+        """
+        if not cls._probed:
+            return cls._probe_hdmi_display()
+        return cls._hdmi_display
+
+    @staticmethod
+    def _probe_hdmi_display():
+        """
+        Ask tvservice whether the display is HDMI. This runs a subprocess.
         """
         try:
             res = subprocess.run(["tvservice", "-s"], stdout=subprocess.PIPE)
@@ -191,74 +350,217 @@ class DisplayController:
 
     @classmethod
     def query_display_state(cls):
-        cls._display_lock.acquire()
-        state = cls._state_unknown
-        if DisplayController.is_raspberry_pi():
+        with cls._display_lock:
+            state = cls._state_unknown
             if DisplayController.is_hdmi_display():
                 # subprocess.run(["vcgencmd", "display_power", "1"])
                 state = cls._state_unknown
-            else:
+            elif cls._backlight is not None:
                 # rpi 7" touchscreen
                 if cls._backlight.power:
                     state = cls._state_display_on
                 else:
                     state = cls._state_display_off
-        else:
-            pass
-        cls._display_lock.release()
+            else:
+                pass
         logger.debug("Current display state %s", cls._display_states[state])
         return state
 
     @classmethod
     def turn_display_on(cls):
-        cls._display_lock.acquire()
-        if DisplayController.is_raspberry_pi():
+        """
+        Turn the display on. Returns without waiting for the hardware
+        when the actuator thread is running.
+        """
+        cls._submit("power", 1)
+
+    @classmethod
+    def turn_display_off(cls):
+        """
+        Turn the display off. Returns without waiting for the hardware
+        when the actuator thread is running.
+        """
+        cls._submit("power", 0)
+
+    @classmethod
+    def set_display_backlight(cls, brightness):
+        """
+        Set the backlight brightness. Returns without waiting for the hardware
+        when the actuator thread is running.
+        :param brightness: 0 <= brightness <= 255
+        """
+        cls._submit("brightness", brightness)
+
+    @classmethod
+    def _submit(cls, command, value):
+        """
+        Hand a display command to the actuator thread, or run it now
+        if there is no actuator thread
+        """
+        if cls._actuator is not None:
+            cls._actuator.submit(command, value)
+        else:
+            cls._apply(command, value)
+
+    @classmethod
+    def _apply(cls, command, value):
+        """
+        Run a display command against the hardware unless it would
+        not change anything
+        :return: True if the hardware was changed
+        """
+        if command == "power":
+            if value == cls._power_state():
+                return False
+            if value:
+                cls._turn_display_on_now()
+            else:
+                cls._turn_display_off_now()
+        elif command == "brightness":
+            if value == cls._brightness:
+                return False
+            cls._set_display_backlight_now(value)
+        return True
+
+    @classmethod
+    def _power_state(cls):
+        """
+        The power state that commands are compared against. A backlight is
+        read back because other programs (DPMS, framebuffer blanking) can
+        change it.
+        :return: 1 (on) or 0 (off)
+        """
+        if cls._backlight is not None and not DisplayController.is_hdmi_display():
+            with cls._display_lock:
+                return 1 if cls._backlight.power else 0
+        return cls._backlight_state
+
+    @classmethod
+    def _turn_display_on_now(cls):
+        with cls._display_lock:
             if DisplayController.is_hdmi_display():
                 subprocess.run(["vcgencmd", "display_power", "1"])
-            else:
+            elif cls._backlight is not None:
                 # rpi 7" touchscreen
                 # a = "echo 0 | sudo tee /sys/class/backlight/rpi_backlight/bl_power"
                 logger.debug("Turning display power on")
                 # subprocess.check_output(a, shell=True)
                 cls._backlight.power = True
-        else:
-            pass
-        cls._backlight_state = 1
-        cls._display_lock.release()
+            else:
+                pass
+            cls._backlight_state = 1
         logger.debug("Display turned on")
 
     @classmethod
-    def turn_display_off(cls):
-        cls._display_lock.acquire()
-        if DisplayController.is_raspberry_pi():
+    def _turn_display_off_now(cls):
+        with cls._display_lock:
             if DisplayController.is_hdmi_display():
                 subprocess.run(["vcgencmd", "display_power", "0"])
-            elif DisplayController.is_raspberry_pi():
+            elif cls._backlight is not None:
                 # rpi 7" touchscreen
                 # a = "echo 1 | sudo tee /sys/class/backlight/rpi_backlight/bl_power"
                 logger.debug("Turning display power off")
                 # subprocess.check_output(a, shell=True)
                 cls._backlight.power = False
-        else:
-            pass
-        cls._backlight_state = 0
-        cls._display_lock.release()
+            else:
+                pass
+            cls._backlight_state = 0
         logger.debug("Display turned off")
 
     @classmethod
-    def set_display_backlight(cls, brightness):
-        cls._display_lock.acquire()
-        if DisplayController.is_raspberry_pi():
+    def _set_display_backlight_now(cls, brightness):
+        with cls._display_lock:
             if DisplayController.is_hdmi_display():
                 pass
-            elif DisplayController.is_raspberry_pi():
+            elif cls._backlight is not None:
                 # rpi 7" touchscreen
                 # a = "echo {0} | sudo tee /sys/class/backlight/rpi_backlight/brightness".format(brightness)
                 logger.debug("Setting display brightness")
                 # subprocess.check_output(a, shell=True)
                 # Scale brightness from 0-255 to 0-100
                 cls._backlight.brightness = int((brightness * 100) / 255)
-        else:
-            pass
-        cls._display_lock.release()
+            else:
+                pass
+            cls._brightness = brightness
         logger.debug("Display backlight brightness set")
+
+
+class DisplayActuator(threading.Thread):
+    """
+    Owns the display hardware. Display commands are queued and run on this
+    thread, so the sensor thread and the Tk thread never wait on vcgencmd or
+    backlight writes. Queued commands of the same kind are coalesced and
+    commands that would not change the display are dropped.
+    """
+    def __init__(self):
+        threading.Thread.__init__(self, name="DisplayActuatorThread", daemon=True)
+        self._commands = CoalescingQueue()
+        # Time from submitting a command until the hardware was changed
+        self.latency = LatenessStats()
+        # Commands that were not needed and commands that raised an exception
+        self.dropped = 0
+        self.failed = 0
+
+    def submit(self, command, value):
+        """
+        Queue a display command. Can be called from any thread.
+        :param command: "power" or "brightness"
+        :param value: 1/0 for power, 0-255 for brightness
+        :return: None
+        """
+        self._commands.put(command, (value, time.monotonic()))
+
+    def run(self):
+        while not self._commands.closed:
+            for command, (value, submitted) in self._commands.get().items():
+                try:
+                    if DisplayController._apply(command, value):
+                        latency = (time.monotonic() - submitted) * 1000.0
+                        self.latency.record(latency)
+                        logger.debug("Display %s %s completed in %.1fms", command, value, latency)
+                    else:
+                        self.dropped += 1
+                except Exception as ex:
+                    # Keep going. The next command may well succeed.
+                    self.failed += 1
+                    logger.error("Display %s %s failed", command, value)
+                    logger.error(str(ex))
+        logger.debug("Display actuator terminated")
+
+    def terminate(self):
+        self._commands.close()
+        self.join()
+
+
+class DisplayHotplugMonitor(threading.Thread):
+    """
+    Watches for HDMI hotplug events (tvservice -M) and re-probes
+    the display when one occurs.
+    """
+    def __init__(self):
+        threading.Thread.__init__(self, name="DisplayHotplugThread", daemon=True)
+        self._proc = None
+        self._terminate_thread = False
+
+    def run(self):
+        try:
+            self._proc = subprocess.Popen(["tvservice", "-M"], stdout=subprocess.PIPE,
+                                          stderr=subprocess.DEVNULL, universal_newlines=True)
+        except Exception as ex:
+            # tvservice is not available on all OS versions
+            logger.debug("Display hotplug monitor not available: %s", str(ex))
+            return
+
+        for line in self._proc.stdout:
+            if self._terminate_thread:
+                break
+            if line.startswith("["):
+                # Event lines look like: [I] HDMI cable is attached
+                logger.debug("Display hotplug event: %s", line.strip())
+                DisplayController.probe_display()
+        logger.debug("Display hotplug monitor terminated")
+
+    def terminate(self):
+        self._terminate_thread = True
+        if self._proc is not None:
+            self._proc.terminate()
@@ -0,0 +1,76 @@
+# -*- coding: UTF-8 -*-
+#
+# Thread safe event queue that keeps only the latest value of each event
+# Copyright © 2018, 2019  Dave Hocker (email: athomex10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import threading
+from collections import OrderedDict
+
+
+class CoalescingQueue:
+    """
+    A queue of keyed events for passing state changes between threads.
+    Only the latest value for each key is kept. If a key is posted again
+    before the consumer gets it, the earlier value is replaced (coalesced).
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._events = OrderedDict()
+        self._closed = False
+        # Counters for monitoring. Only written while holding the lock.
+        self.posted = 0
+        self.coalesced = 0
+
+    def put(self, key, value):
+        """
+        Post an event. Can be called from any thread.
+        :param key: Identifies the kind of event
+        :param value: The new value
+        :return: None
+        """
+        with self._cond:
+            if key in self._events:
+                self.coalesced += 1
+            self._events[key] = value
+            self.posted += 1
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """
+        Wait for events and take all of them
+        :param timeout: Maximum wait in seconds or None to wait until an event is posted
+        :return: An OrderedDict of key: latest value. It is empty if the wait timed
+        out or the queue was closed.
+        """
+        with self._cond:
+            if not self._events and not self._closed:
+                self._cond.wait(timeout)
+            events = self._events
+            self._events = OrderedDict()
+        return events
+
+    def close(self):
+        """
+        Wake up the consumer so it can exit
+        :return: None
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    @property
+    def closed(self):
+        return self._closed
@@ -0,0 +1,95 @@
+# -*- coding: UTF-8 -*-
+#
+# Cached list of installed font families
+# Copyright © 2018, 2019  Dave Hocker (email: athomex10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Asking Tk for the font families is slow on a Raspberry Pi with a lot of
+# fonts installed. The list is kept in a file and reused until fontconfig's
+# cache changes (which happens whenever fonts are installed or removed).
+#
+
+import os
+import os.path
+import json
+from tkinter import font as tkfont
+from configuration import QConfiguration
+from app_logger import AppLogger
+
+
+# Logger init
+the_app_logger = AppLogger("lumiclock")
+logger = the_app_logger.getAppLogger()
+
+
+class FontFamilyCache:
+    """
+    Font family list cache. The list is saved in the configuration folder
+    and used until the fontconfig caches change (a font is installed or removed).
+    """
+    _file_name = "fontfamilies.json"
+    _fontconfig_cache_dirs = ["/var/cache/fontconfig", "~/.cache/fontconfig", "~/.fontconfig"]
+
+    @classmethod
+    def families(cls, root=None):
+        """
+        Return the sorted list of installed font families
+        :param root: Tk root (or any widget) used when the list must be built
+        :return: List of font family names
+        """
+        key = cls._fontconfig_key()
+        cache_file = os.path.join(QConfiguration.file_path, cls._file_name)
+        if key:
+            try:
+                with open(cache_file, "r") as cf:
+                    cached = json.load(cf)
+                if cached["key"] == key:
+                    logger.debug("Font family list loaded from %s", cache_file)
+                    return cached["families"]
+            except FileNotFoundError:
+                pass
+            except Exception as ex:
+                logger.error("Unable to read font family cache %s", cache_file)
+                logger.error(str(ex))
+
+        families = sorted(tkfont.families(root))
+        logger.debug("Font family list built: %d families", len(families))
+        if key:
+            try:
+                temp_file = cache_file + ".tmp"
+                with open(temp_file, "w") as cf:
+                    json.dump({"key": key, "families": families}, cf)
+                os.replace(temp_file, cache_file)
+            except Exception as ex:
+                logger.error("Unable to write font family cache %s", cache_file)
+                logger.error(str(ex))
+        return families
+
+    @classmethod
+    def _fontconfig_key(cls):
+        """
+        Describe the state of the fontconfig cache directories. The key changes
+        when fontconfig rebuilds its cache.
+        :return: A list of [dir, mtime, entries] or an empty list if there is no
+        fontconfig cache (in which case the family list is not cached)
+        """
+        key = []
+        for d in cls._fontconfig_cache_dirs:
+            d = os.path.expanduser(d)
+            if os.path.isdir(d):
+                try:
+                    key.append([d, os.stat(d).st_mtime_ns, len(os.listdir(d))])
+                except OSError:
+                    pass
+        return key
@@ -0,0 +1,632 @@
+# -*- coding: UTF-8 -*-
+#
+# Persistent cache of decoded spinner GIF frames
+# Copyright © 2018, 2019  Dave Hocker (email: athomex10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Decoding a large GIF on a Raspberry Pi is slow. The frames of each
+# spinner are decoded once and written to a cache file as raw buffers.
+# Later loads memory map the cache file and skip GIF decoding entirely.
+#
+# Frames are kept compact. When a GIF uses no more than 256 colors
+# (including transparency), which is almost always the case, the frames
+# are stored as 1 byte per pixel palette indexes with one palette for all
+# frames. Identical frames are stored once.
+#
+# For each frame the cache also records the bounding box of the pixels
+# that differ from the previous frame, so a player can update only the
+# part of the image that changed.
+#
+# Cache file layout
+#   One line of JSON (the header) terminated by a newline
+#   Raw frame data, stored frame after stored frame, each frame_size bytes long
+#
+
+import os
+import os.path
+import json
+import mmap
+import hashlib
+import struct
+import tempfile
+from itertools import count
+from configuration import QConfiguration
+from app_logger import AppLogger
+
+
+# Logger init
+the_app_logger = AppLogger("lumiclock")
+logger = the_app_logger.getAppLogger()
+
+
+def gif_size(gif_path):
+    """
+    Read the logical screen size from a GIF file header
+    :param gif_path: Path to the GIF file
+    :return: (width, height) in pixels
+    """
+    with open(gif_path, "rb") as gf:
+        header = gf.read(10)
+    if len(header) < 10 or header[:3] != b"GIF":
+        raise ValueError("{0} is not a GIF file".format(gif_path))
+    return struct.unpack("<HH", header[6:10])
+
+
+class FrameSet:
+    """
+    The decoded frames of an animated GIF. Each stored frame is a raw buffer
+    so it can be written to and read back from the frame cache without going
+    through the GIF decoder. Frames are stored in P mode (palette indexes
+    with one shared RGBA palette) or, for GIFs with more than 256 colors,
+    in RGBA mode. They are expanded to RGBA when a frame image is requested.
+    """
+    # Mode of the expanded frame images
+    display_mode = "RGBA"
+    # Most colors that can be stored as palette indexes
+    _max_palette_colors = 256
+    # Most pixels converted to palette indexes in one step
+    _batch_pixels = 1 << 22
+
+    def __init__(self, width, height, frames, delay=None, durations=None, mode="RGBA",
+                 palette=None, frame_map=None, deltas=None):
+        """
+        :param width: Frame width in pixels
+        :param height: Frame height in pixels
+        :param frames: List of stored raw frame buffers (bytes or memoryview)
+        :param delay: The GIF duration value or None if the GIF did not have one
+        :param durations: List of per frame durations in ms (None entries
+        for frames without a duration)
+        :param mode: P or RGBA
+        :param palette: For P mode, the palette as bytes (4 bytes, RGBA, per color)
+        :param frame_map: The stored frame used for each GIF frame (None if
+        every GIF frame is stored)
+        :param deltas: For each frame, the box [left, upper, right, lower] of
+        the pixels that differ from the previous frame (the first frame is
+        compared with the last one) or None if the frames are identical.
+        None if the changed regions are not known.
+        """
+        self.width = width
+        self.height = height
+        self.frames = frames
+        self.mode = mode
+        self.palette = palette
+        if frame_map is None:
+            frame_map = list(range(len(frames)))
+        self.frame_map = frame_map
+        self.delay = delay
+        if durations is None:
+            durations = [delay] * len(frame_map)
+        self.durations = durations
+        self.deltas = deltas
+        self._mmap = None
+
+    @classmethod
+    def from_image(cls, im):
+        """
+        Decode every frame of an open GIF image
+        :param im: A PIL Image instance
+        :return: A FrameSet
+        """
+        frames = []
+        durations = []
+        try:
+            for i in count(1):
+                frames.append(im.convert(cls.display_mode).tobytes())
+                durations.append(im.info.get("duration"))
+                im.seek(i)
+        except EOFError:
+            pass
+        delay = im.info.get("duration")
+        return cls.compact(im.size[0], im.size[1], frames, delay=delay, durations=durations)
+
+    @classmethod
+    def compact(cls, width, height, frames, delay=None, durations=None):
+        """
+        Build a frame set from RGBA frames, storing identical frames once and
+        using palette indexes if there are few enough colors
+        :param width: Frame width in pixels
+        :param height: Frame height in pixels
+        :param frames: List of RGBA frame buffers (bytes)
+        :param delay: The GIF duration value
+        :param durations: List of per frame durations in ms
+        :return: A FrameSet
+        """
+        stored = []
+        frame_map = []
+        index_of = {}
+        for f in frames:
+            index = index_of.get(f)
+            if index is None:
+                index = len(stored)
+                index_of[f] = index
+                stored.append(f)
+            frame_map.append(index)
+
+        from PIL import Image
+        colors = set()
+        for f in stored:
+            found = Image.frombuffer("RGBA", (width, height), f, "raw", "RGBA", 0, 1).getcolors(
+                cls._max_palette_colors)
+            if found is not None:
+                colors.update(c for _, c in found)
+            if found is None or len(colors) > cls._max_palette_colors:
+                deltas = cls._frame_deltas(width, height, 4, stored, frame_map)
+                return cls(width, height, stored, delay=delay, durations=durations, frame_map=frame_map,
+                           deltas=deltas)
+
+        colors = sorted(colors)
+        palette = b"".join(bytes(c) for c in colors)
+        indexed = cls._palette_indexes(width, height, stored, colors)
+        deltas = cls._frame_deltas(width, height, 1, indexed, frame_map)
+        return cls(width, height, indexed, delay=delay, durations=durations, mode="P",
+                   palette=palette, frame_map=frame_map, deltas=deltas)
+
+    @classmethod
+    def _palette_indexes(cls, width, height, frames, colors):
+        """
+        Convert RGBA frames to palette indexes. Pillow has no exact RGBA to
+        palette conversion, so each pixel is split into its red/green and
+        blue/alpha halves. Each half is numbered through a lookup table and
+        the pair of numbers is then looked up to give the palette index. The
+        lookups are done by Image.point, so no pixel is handled in Python.
+        :param width: Frame width in pixels
+        :param height: Frame height in pixels
+        :param frames: List of RGBA frame buffers
+        :param colors: The palette as a list of (r, g, b, a) tuples. Every
+        pixel color must be in it.
+        :return: List of palette index frame buffers (bytes)
+        """
+        from PIL import Image
+        # There are no more distinct halves than colors, so each half
+        # is numbered in 1 byte
+        rg_numbers = {}
+        ba_numbers = {}
+        for r, g, b, a in colors:
+            rg_numbers.setdefault(r | (g << 8), len(rg_numbers))
+            ba_numbers.setdefault(b | (a << 8), len(ba_numbers))
+        rg_lut = [0] * 65536
+        for half, number in rg_numbers.items():
+            rg_lut[half] = number
+        ba_lut = [0] * 65536
+        for half, number in ba_numbers.items():
+            ba_lut[half] = number
+        pair_lut = [0] * 65536
+        for index, (r, g, b, a) in enumerate(colors):
+            pair_lut[rg_numbers[r | (g << 8)] | (ba_numbers[b | (a << 8)] << 8)] = index
+
+        def lookup(size, halves, lut):
+            # The halves buffer holds one little endian 16 bit value per pixel
+            return Image.frombytes("I", size, bytes(halves), "raw", "I;16").point(lut, "L").tobytes()
+
+        # Image.point prepares its lookup table on every call, which costs
+        # more than mapping a small frame, so frames are mapped in batches
+        frame_pixels = width * height
+        batch = max(1, cls._batch_pixels // frame_pixels)
+        indexed = []
+        for first in range(0, len(frames), batch):
+            data = b"".join(frames[first:first + batch])
+            size = (width, height * (len(data) // (frame_pixels * 4)))
+            halves = bytearray(len(data) // 2)
+            halves[0::2] = data[0::4]
+            halves[1::2] = data[1::4]
+            rg = lookup(size, halves, rg_lut)
+            halves[0::2] = data[2::4]
+            halves[1::2] = data[3::4]
+            ba = lookup(size, halves, ba_lut)
+            halves[0::2] = rg
+            halves[1::2] = ba
+            mapped = lookup(size, halves, pair_lut)
+            indexed.extend(mapped[i:i + frame_pixels] for i in range(0, len(mapped), frame_pixels))
+        return indexed
+
+    @staticmethod
+    def _frame_deltas(width, height, bytes_per_pixel, frames, frame_map):
+        """
+        Find the region of each frame that differs from the previous frame
+        :param width: Frame width in pixels
+        :param height: Frame height in pixels
+        :param bytes_per_pixel: 1 (P) or 4 (RGBA)
+        :param frames: List of stored raw frame buffers
+        :param frame_map: The stored frame used for each GIF frame
+        :return: List of [left, upper, right, lower] or None for each frame
+        """
+        from PIL import Image, ImageChops
+        # The buffers are compared byte by byte as L images, so a changed
+        # RGBA pixel shows up as up to 4 changed bytes in a row
+        size = (width * bytes_per_pixel, height)
+        boxes = {}
+        deltas = []
+        for i, stored in enumerate(frame_map):
+            previous = frame_map[i - 1]
+            if previous == stored:
+                deltas.append(None)
+                continue
+            key = (previous, stored)
+            if key not in boxes:
+                box = ImageChops.difference(Image.frombuffer("L", size, frames[previous], "raw", "L", 0, 1),
+                                            Image.frombuffer("L", size, frames[stored], "raw", "L", 0, 1)).getbbox()
+                if box is not None:
+                    box = [box[0] // bytes_per_pixel, box[1],
+                           (box[2] + bytes_per_pixel - 1) // bytes_per_pixel, box[3]]
+                boxes[key] = box
+            deltas.append(boxes[key])
+        return deltas
+
+    def __len__(self):
+        return len(self.frame_map)
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+    @property
+    def frame_size(self):
+        """
+        Bytes per stored frame
+        """
+        return self.width * self.height * (1 if self.mode == "P" else 4)
+
+    @property
+    def display_frame_size(self):
+        """
+        Bytes per expanded (displayed) frame
+        """
+        return self.width * self.height * 4
+
+    @property
+    def memory_size(self):
+        """
+        Bytes used by the stored frames
+        """
+        return (len(self.frames) * self.frame_size) + (len(self.palette) if self.palette else 0)
+
+    def duration(self, index):
+        """
+        :param index: Frame number
+        :return: The frame's duration in ms or None if the GIF did not specify one
+        """
+        return self.durations[index]
+
+    def stored_index(self, index):
+        """
+        :param index: Frame number
+        :return: The number of the stored frame it uses. Identical frames
+        have the same stored frame.
+        """
+        return self.frame_map[index]
+
+    def changed_box(self, shown, index):
+        """
+        The region that has to be updated to go from one frame to another.
+        Going forward over several frames covers every frame's changes.
+        :param shown: Frame number on display
+        :param index: Frame number to be shown
+        :return: (left, upper, right, lower) or None if nothing changes
+        """
+        if self.deltas is None:
+            return (0, 0, self.width, self.height)
+        box = None
+        while shown != index:
+            shown = (shown + 1) % len(self.frame_map)
+            delta = self.deltas[shown]
+            if delta is None:
+                continue
+            if box is None:
+                box = list(delta)
+            else:
+                box = [min(box[0], delta[0]), min(box[1], delta[1]),
+                       max(box[2], delta[2]), max(box[3], delta[3])]
+        return tuple(box) if box is not None else None
+
+    def image(self, index, box=None):
+        """
+        Return a frame as a PIL image. When the frame set came from the
+        cache the image references the memory mapped file (no copy).
+        :param index: Frame number
+        :param box: (left, upper, right, lower) to return only that region
+        of the frame or None for the whole frame
+        :return: PIL Image
+        """
+        # Pillow is imported when it is first needed. It is slow to import on a Pi.
+        from PIL import Image
+        buffer = self.frames[self.frame_map[index]]
+        if self.mode == "P":
+            im = Image.frombuffer("P", self.size, buffer, "raw", "P", 0, 1)
+            if box is not None:
+                # Only the region is expanded
+                im = im.crop(box)
+            im.putpalette(self.palette, "RGBA")
+            return im.convert(self.display_mode)
+        im = Image.frombuffer(self.mode, self.size, buffer, "raw", self.mode, 0, 1)
+        if box is not None:
+            return im.crop(box)
+        return im
+
+    def close(self):
+        """
+        Release the frame buffers and the memory map behind them (if any)
+        :return: None
+        """
+        for f in self.frames:
+            if isinstance(f, memoryview):
+                f.release()
+        self.frames = []
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # A frame image still references the map. It will be
+                # released when the last reference goes away.
+                pass
+            self._mmap = None
+
+
+class FrameStream:
+    """
+    Decodes the frames of an open GIF on demand. It has the same interface
+    as FrameSet, but only the frame being decoded is held in memory.
+    """
+    mode = FrameSet.display_mode
+    bytes_per_pixel = 4
+    # The changes between frames are not known until they are decoded
+    deltas = None
+
+    def __init__(self, im):
+        """
+        :param im: An open PIL Image instance
+        """
+        self._im = im
+        self.width, self.height = im.size
+        self._count = getattr(im, "n_frames", 1)
+        self.delay = im.info.get("duration")
+        # Durations become known as frames are decoded
+        self.durations = [None] * self._count
+        self.durations[0] = self.delay
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+    @property
+    def frame_size(self):
+        return self.width * self.height * self.bytes_per_pixel
+
+    @property
+    def display_frame_size(self):
+        return self.frame_size
+
+    @property
+    def memory_size(self):
+        # Only the frame being decoded
+        return self.frame_size
+
+    def stored_index(self, index):
+        return index
+
+    def changed_box(self, shown, index):
+        return (0, 0, self.width, self.height)
+
+    def image(self, index, box=None):
+        """
+        Decode a frame. Seeking forward is cheap. Seeking backward
+        makes the decoder start over from the first frame.
+        :param index: Frame number
+        :param box: (left, upper, right, lower) to return only that region
+        of the frame or None for the whole frame
+        :return: PIL Image
+        """
+        self._im.seek(index)
+        self.durations[index] = self._im.info.get("duration")
+        im = self._im.convert(self.mode)
+        if box is not None:
+            return im.crop(box)
+        return im
+
+    def duration(self, index):
+        """
+        :param index: Frame number
+        :return: The frame's duration in ms. Until the frame has been decoded
+        this is the first frame's duration.
+        """
+        if self.durations[index] is None:
+            return self.delay
+        return self.durations[index]
+
+    def close(self):
+        if self._im is not None:
+            self._im.close()
+            self._im = None
+
+
+class FrameCache:
+    """
+    On disk cache of decoded GIF frames, kept in the framecache folder under
+    the configuration folder. Entries are keyed by the GIF file's path,
+    modification time and frame size.
+    """
+    _version = 4
+    _suffix = ".frames"
+
+    @classmethod
+    def cache_dir(cls):
+        return os.path.join(QConfiguration.file_path, "framecache")
+
+    @classmethod
+    def load_frames(cls, gif_path):
+        """
+        Return the decoded frames of a GIF file, from the cache if possible.
+        On a cache miss the GIF is decoded and the result is cached.
+        :param gif_path: Path to the GIF file
+        :return: A FrameSet
+        """
+        # A cache hit needs only the GIF header, not Pillow
+        cache_file = cls._cache_file(gif_path, gif_size(gif_path))
+
+        frameset = cls.get(cache_file)
+        if frameset is not None:
+            logger.debug("Frame cache hit for %s: %s", gif_path, cache_file)
+            return frameset
+
+        from PIL import Image
+        im = Image.open(gif_path)
+        frameset = FrameSet.from_image(im)
+        im.close()
+        logger.debug("Frame cache miss for %s", gif_path)
+        try:
+            cls.put(cache_file, frameset)
+            # Trade the decoded frames for the memory mapped copy
+            cached = cls.get(cache_file)
+            if cached is not None:
+                frameset.close()
+                frameset = cached
+        except Exception as ex:
+            # The cache is an optimization. Failing to write it is not fatal.
+            logger.error("Unable to write frame cache %s", cache_file)
+            logger.error(str(ex))
+        return frameset
+
+    @classmethod
+    def get(cls, cache_file):
+        """
+        Read a cached frame set
+        :param cache_file: Full path of the cache file
+        :return: A FrameSet backed by a memory map or None if there is no usable entry
+        """
+        if not os.path.exists(cache_file):
+            return None
+
+        try:
+            with open(cache_file, "rb") as cf:
+                mm = mmap.mmap(cf.fileno(), 0, access=mmap.ACCESS_READ)
+            header_end = mm.find(b"\n")
+            header = json.loads(mm[:header_end].decode("utf-8"))
+            if header["version"] != cls._version or header["mode"] not in ["P", "RGBA"]:
+                mm.close()
+                return None
+
+            frame_size = header["frame_size"]
+            offset = header_end + 1
+            if not cls._is_consistent(header, len(mm) - offset):
+                # Truncated or otherwise damaged
+                mm.close()
+                return None
+
+            view = memoryview(mm)
+            frames = [view[offset + (i * frame_size):offset + ((i + 1) * frame_size)]
+                      for i in range(header["stored"])]
+            view.release()
+            palette = bytes.fromhex(header["palette"]) if header["palette"] else None
+            frameset = FrameSet(header["width"], header["height"], frames,
+                                delay=header["delay"], durations=header["durations"],
+                                mode=header["mode"], palette=palette, frame_map=header["frame_map"],
+                                deltas=header["deltas"])
+            frameset._mmap = mm
+            return frameset
+        except Exception as ex:
+            logger.error("Unable to read frame cache %s", cache_file)
+            logger.error(str(ex))
+        return None
+
+    @staticmethod
+    def _is_consistent(header, data_size):
+        """
+        Check that a cache file header describes the frame data that follows it
+        :param header: The header as a dict
+        :param data_size: Bytes of frame data after the header
+        :return: True if the header can be trusted
+        """
+        count = header["count"]
+        stored = header["stored"]
+        bytes_per_pixel = 1 if header["mode"] == "P" else 4
+        if header["frame_size"] != header["width"] * header["height"] * bytes_per_pixel:
+            return False
+        if data_size != header["frame_size"] * stored:
+            return False
+        if len(header["frame_map"]) != count or len(header["durations"]) != count:
+            return False
+        if header["deltas"] is not None and len(header["deltas"]) != count:
+            return False
+        return all(0 <= i < stored for i in header["frame_map"])
+
+    @classmethod
+    def put(cls, cache_file, frameset):
+        """
+        Write a frame set to the cache. The file is written under a temporary
+        name and renamed so a partially written file is never used. Several
+        loader threads can write the same entry at once, so each one has its
+        own temporary file.
+        :param cache_file: Full path of the cache file
+        :param frameset: The FrameSet to be cached
+        :return: None
+        """
+        cache_dir = os.path.dirname(cache_file)
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # Remove stale entries for the same GIF. The entry being written is
+        # replaced by the rename (another thread may have just written it).
+        prefix = os.path.basename(cache_file).split("-")[0] + "-"
+        for f in os.listdir(cache_dir):
+            if f.startswith(prefix) and f.endswith(cls._suffix) and f != os.path.basename(cache_file):
+                try:
+                    os.remove(os.path.join(cache_dir, f))
+                except FileNotFoundError:
+                    # Another thread removed it
+                    pass
+
+        header = {
+            "version": cls._version,
+            "mode": frameset.mode,
+            "width": frameset.width,
+            "height": frameset.height,
+            "count": len(frameset),
+            "stored": len(frameset.frames),
+            "frame_size": frameset.frame_size,
+            "palette": frameset.palette.hex() if frameset.palette else None,
+            "frame_map": frameset.frame_map,
+            "delay": frameset.delay,
+            "durations": frameset.durations,
+            "deltas": frameset.deltas,
+        }
+        fd, temp_file = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        try:
+            with open(fd, "wb") as cf:
+                cf.write(json.dumps(header).encode("utf-8"))
+                cf.write(b"\n")
+                for f in frameset.frames:
+                    cf.write(f)
+            os.replace(temp_file, cache_file)
+        except Exception:
+            os.remove(temp_file)
+            raise
+        logger.debug("Frame cache written: %s", cache_file)
+
+    @classmethod
+    def _cache_file(cls, gif_path, size):
+        """
+        Build the cache file name for a GIF. The name has two parts: a hash of
+        the GIF path (used to find stale entries) and a hash of the
+        modification time and frame size.
+        :param gif_path: Path to the GIF file
+        :param size: (width, height) of the GIF frames
+        :return: Full path of the cache file
+        """
+        real_path = os.path.realpath(gif_path)
+        mtime = os.stat(real_path).st_mtime_ns
+        path_hash = hashlib.sha1(real_path.encode("utf-8")).hexdigest()[:16]
+        key = "{0}|{1}x{2}".format(mtime, size[0], size[1])
+        key_hash = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(cls.cache_dir(), path_hash + "-" + key_hash + cls._suffix)
@@ -0,0 +1,167 @@
+# -*- coding: UTF-8 -*-
+#
+# Pre-rendered clock digits
+# Copyright © 2018, 2019  Dave Hocker (email: athomex10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# At the default size the clock digits are almost half the screen height.
+# Drawing them as label text makes Tk lay out and rasterize every glyph
+# each time the text changes. Instead, the characters the clock uses are
+# rasterized once (with Pillow) for the current font, size and color, and
+# the clock face is assembled by copying those images into one Tk image.
+#
+# The font file is found with fc-match (fontconfig), so this only works
+# where fontconfig is installed (Raspberry Pi OS and most Linux systems).
+#
+
+import subprocess
+import functools
+import tkinter as tk # In python2 it's Tkinter
+from app_logger import AppLogger
+
+
+# Logger init
+the_app_logger = AppLogger("lumiclock")
+logger = the_app_logger.getAppLogger()
+
+
+@functools.lru_cache(maxsize=32)
+def find_font_file(family):
+    """
+    Ask fontconfig for the file of a font family. The answer is remembered,
+    so fc-match runs once per family rather than on every font size change.
+    :param family: Font family name
+    :return: Full path of the font file or None if it could not be found
+    """
+    try:
+        res = subprocess.run(["fc-match", "-f", "%{file}", family],
+                             stdout=subprocess.PIPE, timeout=10)
+        font_file = str(res.stdout, 'utf-8').strip()
+        if res.returncode == 0 and font_file:
+            return font_file
+    except Exception as ex:
+        logger.error("Unable to find font file for %s", family)
+        logger.error(str(ex))
+    return None
+
+
+class GlyphAtlas:
+    """
+    The characters used by the clock, each rasterized once into a Tk image.
+    Every glyph image is exactly as wide as the character's advance and as
+    tall as the font's line, so glyphs placed side by side tile the clock face.
+    """
+    # Digits, the colon, the PM dot and the blank that takes its place
+    characters = "0123456789:. "
+
+    def __init__(self, font_file, pixel_size, color, background="black"):
+        """
+        Must be called on the Tk thread
+        :param font_file: Full path of a TrueType/OpenType font file
+        :param pixel_size: Font size in pixels
+        :param color: Glyph color (a Tk/PIL color like #EC3818)
+        :param background: Background color
+        """
+        from PIL import Image, ImageDraw, ImageFont, ImageTk
+        font = ImageFont.truetype(font_file, pixel_size)
+        # Some fonts (Digital 7) have negative descent values
+        ascent, descent = font.getmetrics()
+        self.ascent = abs(ascent)
+        self.height = abs(ascent) + abs(descent)
+        self.font_file = font_file
+        self.glyphs = {}
+        self.advances = {}
+        # The PM dot blinks, so the dot and the blank are made the same
+        # width. Otherwise the whole face would move every second.
+        blink_advance = int(round(max(font.getlength("."), font.getlength(" "))))
+        for ch in self.characters:
+            if ch in ". ":
+                advance = max(1, blink_advance)
+            else:
+                advance = max(1, int(round(font.getlength(ch))))
+            im = Image.new("RGB", (advance, self.height), background)
+            ImageDraw.Draw(im).text((0, self.ascent), ch, font=font, fill=color, anchor="ls")
+            self.glyphs[ch] = ImageTk.PhotoImage(im)
+            self.advances[ch] = advance
+
+    def text_width(self, text):
+        return sum(self.advances[ch] for ch in text)
+
+
+class GlyphClockFace:
+    """
+    A Tk image of the clock text built from a glyph atlas. When the text
+    changes, only the glyphs from the first changed character on are copied.
+    """
+    def __init__(self, atlas):
+        """
+        :param atlas: A GlyphAtlas
+        """
+        self.atlas = atlas
+        self.image = tk.PhotoImage(width=1, height=atlas.height)
+        self.text = ""
+        self.width = 0
+        # Number of glyph copies, for monitoring
+        self.blits = 0
+
+    @classmethod
+    def create(cls, family, pixel_size, color):
+        """
+        Build the atlas and the face for a font
+        :param family: Font family name
+        :param pixel_size: Font size in pixels
+        :param color: Glyph color
+        :return: A GlyphClockFace or None if the font could not be rasterized
+        """
+        font_file = find_font_file(family)
+        if font_file is None:
+            return None
+        try:
+            atlas = GlyphAtlas(font_file, pixel_size, color)
+        except Exception as ex:
+            logger.error("Unable to build glyph atlas from %s", font_file)
+            logger.error(str(ex))
+            return None
+        logger.debug("Glyph atlas built from %s: %d pixels, %d high",
+                     font_file, pixel_size, atlas.height)
+        return cls(atlas)
+
+    @property
+    def height(self):
+        return self.atlas.height
+
+    def set_text(self, text):
+        """
+        Show new clock text
+        :param text: The text. Characters not in the atlas are shown as blanks.
+        :return: None
+        """
+        text = "".join(ch if ch in self.atlas.advances else " " for ch in text)
+        width = self.atlas.text_width(text)
+        start = 0
+        if width != self.width:
+            # Everything moves
+            self.image.configure(width=width)
+            self.width = width
+        else:
+            # The leading characters that did not change are already in place
+            while start < len(text) and start < len(self.text) and text[start] == self.text[start]:
+                start += 1
+
+        x = self.atlas.text_width(text[:start])
+        for ch in text[start:]:
+            self.image.tk.call(self.image, "copy", self.atlas.glyphs[ch], "-to", x, 0)
+            x += self.atlas.advances[ch]
+            self.blits += 1
+        self.text = text
@@ -0,0 +1,171 @@
+# -*- coding: UTF-8 -*-
+#
+# GPIO backends for the PIR sensor thread
+# Copyright © 2018, 2019  Dave Hocker (email: athomex10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# A backend supplies both the sensor input and the clock the sensor
+# thread runs on. The RPi backend uses the real GPIO pins and real time.
+# The simulated backend replays a recorded sensor trace in virtual time,
+# so days of sensor data can be run through the sensor thread in seconds.
+#
+# Trace file format
+#   One sensor change per line: seconds since the start of the trace, value
+#   0,0
+#   12.5,1
+#   15,0
+#   Lines starting with # are comments.
+#
+
+import time
+import bisect
+import threading
+from app_logger import AppLogger
+
+
+# Logger init
+the_app_logger = AppLogger("lumiclock")
+logger = the_app_logger.getAppLogger()
+
+
+class RPiGPIOBackend:
+    """
+    Raspberry Pi GPIO pins (via RPi.GPIO) and the real clock
+    """
+    def __init__(self):
+        # Only import RPi.GPIO when the real hardware is used
+        import RPi.GPIO as GPIO
+        self._gpio = GPIO
+
+    def setup_input(self, pin):
+        # Using board numbering as opposed to BCM numbering
+        self._gpio.setmode(self._gpio.BOARD)
+        # Using pin for input only
+        self._gpio.setup(pin, self._gpio.IN)
+
+    def input(self, pin):
+        return self._gpio.input(pin)
+
+    def add_edge_callback(self, pin, callback):
+        """
+        Call callback(pin) on both rising and falling edges. The
+        callback runs on the GPIO library's thread.
+        """
+        self._gpio.add_event_detect(pin, self._gpio.BOTH, callback=callback)
+
+    def remove_edge_callback(self, pin):
+        self._gpio.remove_event_detect(pin)
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def wait(self, event, timeout):
+        """
+        Wait for a threading.Event
+        :return: True if the event was set
+        """
+        return event.wait(timeout)
+
+
+class SimulatedGPIOBackend:
+    """
+    Replays a sensor trace in virtual time. The virtual clock only moves
+    when the sensor thread sleeps or waits, so a trace runs as fast as the
+    sensor thread can process it. If speed is given, the virtual clock
+    runs that many times faster than real time instead.
+    """
+    def __init__(self, trace, speed=None):
+        """
+        :param trace: List of (seconds, value) sensor changes in time order
+        :param speed: None to run as fast as possible or a real time multiplier
+        """
+        self._times = [t for t, v in trace]
+        self._values = [v for t, v in trace]
+        self._speed = speed
+        self._now = 0.0
+        self._callbacks = {}
+        # Set when the virtual clock passes the end of the trace
+        self.finished = threading.Event()
+
+    @classmethod
+    def load_trace(cls, file_path):
+        """
+        Read a trace file
+        :param file_path: Path to the trace file
+        :return: List of (seconds, value) tuples
+        """
+        trace = []
+        with open(file_path, "r") as tf:
+            for line in tf:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                t, v = line.split(",")
+                trace.append((float(t), int(v)))
+        trace.sort(key=lambda c: c[0])
+        return trace
+
+    @property
+    def end_time(self):
+        return self._times[-1] if self._times else 0.0
+
+    def setup_input(self, pin):
+        pass
+
+    def input(self, pin):
+        i = bisect.bisect_right(self._times, self._now) - 1
+        return self._values[i] if i >= 0 else 0
+
+    def add_edge_callback(self, pin, callback):
+        self._callbacks[pin] = callback
+
+    def remove_edge_callback(self, pin):
+        self._callbacks.pop(pin, None)
+
+    def monotonic(self):
+        return self._now
+
+    def sleep(self, seconds):
+        self._advance(self._now + seconds)
+
+    def wait(self, event, timeout):
+        """
+        Wait for a threading.Event in virtual time. The next sensor change
+        within the timeout fires the edge callbacks, which normally set the event.
+        :return: True if the event was set
+        """
+        if event.is_set():
+            return True
+        if timeout is None:
+            timeout = self.end_time - self._now + 1.0
+        until = self._now + timeout
+
+        i = bisect.bisect_right(self._times, self._now)
+        if i < len(self._times) and self._times[i] <= until:
+            self._advance(self._times[i])
+            for pin, callback in list(self._callbacks.items()):
+                callback(pin)
+        else:
+            self._advance(until)
+        return event.is_set()
+
+    def _advance(self, new_now):
+        if self._speed:
+            time.sleep((new_now - self._now) / self._speed)
+        self._now = new_now
+        if self._now > self.end_time:
+            self.finished.set()
@@ -15,13 +15,24 @@
 # You should have received a copy of the GNU General Public License
 # along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
 #
+# Usage
+#   python lumiclock.py [--profile-startup]
+# --profile-startup (or the LUMICLOCK_PROFILE_STARTUP environment variable)
+# logs how long each startup phase took and the time to the first frame.
+#
 
+import time
+_start_time = time.perf_counter()
 
 import tkinter as tk # In python2 it's Tkinter
 import os
+import sys
+import signal
 from lumiclock_app import LumiClockApplication
 from display_controller import DisplayController
 from configuration import QConfiguration
+from startup_profiler import StartupProfiler
+from tk_instrumentation import TkInstrumentation
 from app_logger import AppLogger
 
 
@@ -29,25 +40,145 @@ from app_logger import AppLogger
 the_app_logger = AppLogger("lumiclock")
 logger = the_app_logger.getAppLogger()
 
+_imports_time = time.perf_counter() - _start_time
+
+
+def install_log_dump_handler(root):
+    """
+    kill -USR1 <pid> dumps the in-memory log ring buffer for troubleshooting.
+    The signal handler only schedules the dump on the Tk thread. The dump
+    writes a file and logs, and the signal can arrive while the Tk thread
+    is inside a logging call that holds the log queue's lock.
+    :param root: The Tk root window
+    :return: None
+    """
+    if not hasattr(signal, "SIGUSR1"):
+        return
+
+    def request_dump(signum, frame):
+        root.after_idle(the_app_logger.dump_log_buffer)
+    signal.signal(signal.SIGUSR1, request_dump)
+
+
+def create_status_server(app, sensor, display_controller):
+    """
+    Set up the status endpoint. The metric sources run on the
+    status server thread and only read values.
+    :return: A StatusServer (not started)
+    """
+    # Imported only when the endpoint is enabled. http.server is slow to import.
+    from status_server import StatusServer, process_memory
+    server = StatusServer(QConfiguration.statusport)
+    server.add_metric("display_state", "Display state", display_controller.get_display_state)
+    server.add_metric("display_events_posted_total", "Sensor events posted to the display controller",
+                      lambda: display_controller.events_posted, "counter")
+    server.add_metric("display_events_coalesced_total", "Sensor events replaced by a newer one before "
+                      "they were handled", lambda: display_controller.events_coalesced, "counter")
+    if sensor:
+        server.add_metric("pir_sensor", "PIR sensor value", lambda: int(sensor.sensor_value))
+        server.add_metric("pir_off_counter_seconds", "Seconds until the display is turned off",
+                          lambda: sensor.off_counter)
+        server.add_metric("pir_on_counter_seconds", "Seconds until the display is turned on",
+                          lambda: sensor.on_counter)
+    server.add_metric("clock_ticks_total", "Clock ticks", lambda: app.clock_lateness.count, "counter")
+    server.add_metric("clock_lateness_ms", "Average clock tick lateness",
+                      lambda: round(app.clock_lateness.average, 1))
+    server.add_metric("clock_lateness_max_ms", "Largest clock tick lateness",
+                      lambda: round(app.clock_lateness.max, 1))
+    server.add_metric("clock_skipped_total", "Clock seconds skipped", lambda: app.clock_lateness.skipped,
+                      "counter")
+    server.add_metric("frames_total", "Spinner frames shown", lambda: app.image_label.frame_lateness.count,
+                      "counter")
+    server.add_metric("frame_lateness_ms", "Average spinner frame lateness",
+                      lambda: round(app.image_label.frame_lateness.average, 1))
+    server.add_metric("frame_lateness_max_ms", "Largest spinner frame lateness",
+                      lambda: round(app.image_label.frame_lateness.max, 1))
+    server.add_metric("frames_skipped_total", "Spinner frames skipped to catch up",
+                      lambda: app.image_label.frame_lateness.skipped, "counter")
+    server.add_metric("spinner_resident_frames", "Spinner frames held in memory",
+                      lambda: app.image_label.resident_frames)
+    server.add_metric("spinner_delta_pixels_total", "Spinner pixels updated in place (deltaframes)",
+                      lambda: app.image_label.delta_pixels, "counter")
+
+    def actuator_latency():
+        actuator = DisplayController.actuator()
+        return round(actuator.latency.average, 1) if actuator is not None else None
+    server.add_metric("display_command_latency_ms", "Average time to carry out a display command",
+                      actuator_latency)
+
+    def actuator_count(name):
+        actuator = DisplayController.actuator()
+        return getattr(actuator, name) if actuator is not None else None
+    server.add_metric("display_commands_dropped_total", "Display commands skipped because they would not "
+                      "change the display", lambda: actuator_count("dropped"), "counter")
+    server.add_metric("display_commands_failed_total", "Display commands that raised an exception",
+                      lambda: actuator_count("failed"), "counter")
+
+    def backlight_writes(i):
+        writes = DisplayController.backlight_writes()
+        return writes[i] if writes is not None else None
+    server.add_metric("backlight_writes_total", "Values written to the backlight",
+                      lambda: backlight_writes(0), "counter")
+    server.add_metric("backlight_skipped_writes_total", "Backlight writes skipped because the value "
+                      "was already set", lambda: backlight_writes(1), "counter")
+    server.add_metric("glyph_blits_total", "Glyph images copied into the clock face",
+                      lambda: app.glyph_blits, "counter")
+    server.add_metric("debug_overlay_refreshes_total", "Debug overlay refreshes",
+                      lambda: app.debug_overlay.refreshes, "counter")
+    server.add_metric("debug_overlay_renders_total", "Debug overlay fields rendered",
+                      lambda: app.debug_overlay.renders, "counter")
+    server.add_metric("debug_overlay_updates_total", "Debug overlay text changes",
+                      lambda: app.debug_overlay.updates, "counter")
+    server.add_metric("log_flushes_total", "Batches written to the log file", the_app_logger.log_flushes,
+                      "counter")
+    server.add_metric("log_records_dropped_total", "Log records dropped because the log queue was full",
+                      the_app_logger.dropped_records, "counter")
+    server.add_metric("resident_memory_bytes", "Resident memory", lambda: process_memory()[0])
+    server.add_metric("peak_resident_memory_bytes", "Peak resident memory", lambda: process_memory()[1])
+    return server
+
 
 def main():
+    if "--profile-startup" in sys.argv[1:] or os.environ.get("LUMICLOCK_PROFILE_STARTUP"):
+        StartupProfiler.start(_start_time)
+        StartupProfiler.record("imports", _imports_time)
+
+    with StartupProfiler.phase("config load"):
+        QConfiguration.load()
+
+    # Measure Tk callbacks. This must happen before any are scheduled.
+    if QConfiguration.instrumentation:
+        TkInstrumentation.install()
+
     # Create state machine for display
-    display_controller = DisplayController()
+    with StartupProfiler.phase("display probe"):
+        display_controller = DisplayController()
+    display_controller.start()
 
     # Start the PIR sensor monitor
     threadinst = None
     if QConfiguration.pirsensor:
         from pir_sensor_thread import SensorThread
-        threadinst = SensorThread(notify=display_controller.set_display_state,
+        threadinst = SensorThread(notify=display_controller.post_sensor_value,
                                   pir_pin=QConfiguration.pirpin,
                                   time_off=QConfiguration.timeout,
-                                  time_on=QConfiguration.timein)
+                                  time_on=QConfiguration.timein,
+                                  mode=QConfiguration.pirmode)
         threadinst.start()
 
     # Create main window and run the event loop
     root = tk.Tk()
     app = LumiClockApplication(master=root, sensor=threadinst, display=display_controller)
     root.title('LumiClock')
+    install_log_dump_handler(root)
+
+    # Local status endpoint for monitoring
+    status_server = None
+    if QConfiguration.statusport:
+        status_server = create_status_server(app, threadinst, display_controller)
+        status_server.start()
+    if TkInstrumentation.installed:
+        TkInstrumentation.start_reporting(root, QConfiguration.instrumentationreport)
 
     # Set up icon
     try:
@@ -62,11 +193,19 @@ def main():
     except Exception as ex:
         logger.error(str(ex))
 
+    # The clock face is drawn by the first idle pass of the event loop
+    root.after_idle(StartupProfiler.first_frame)
     root.mainloop()
 
     # Terminate sensor monitor
     if QConfiguration.pirsensor:
         threadinst.terminate()
+    display_controller.stop()
+    if status_server is not None:
+        status_server.terminate()
+    TkInstrumentation.log_summary()
+    QConfiguration.flush_pending_save()
+    the_app_logger.Shutdown()
 
 
 if __name__ == '__main__':
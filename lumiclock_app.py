@@ -19,11 +19,20 @@
 import tkinter as tk # In python2 it's Tkinter
 from tkinter import font as tkfont, messagebox
 import datetime
+import time
+import math
 import glob
 from functools import partial
 from animated_gif_label import AnimatedGIFLabel
+from font_families import FontFamilyCache
+from glyph_atlas import GlyphClockFace
+from compositor import Compositor, CanvasGIFItem
+from debug_overlay import DebugOverlay
+from tk_instrumentation import TkInstrumentation
 from configuration import QConfiguration
 from display_controller import DisplayController
+from timing_stats import LatenessStats
+from startup_profiler import StartupProfiler
 from app_logger import AppLogger
 
 
@@ -36,6 +45,16 @@ class LumiClockApplication(tk.Frame):
     """
     Main window of the application. Designed to be a singleton.
     """
+    # The clock tick is scheduled this many ms after each second boundary
+    # so Tk timer jitter cannot make it run before the boundary.
+    _tick_guard_ms = 5
+    # How often the display state is checked while in power save
+    _idle_poll_ms = 500
+    # How often the configuration file is checked for changes
+    _config_poll_ms = 2000
+    # Debug display refresh interval
+    _debug_refresh_ms = 1000
+
     def __init__(self, master=None, sensor=None, display=None):
         tk.Frame.__init__(self, master, bg='black')
         self._sensor = sensor
@@ -47,6 +66,18 @@ class LumiClockApplication(tk.Frame):
         self.run_clock = False
         self._debug_lines = 2
         self._menu_showing = False
+        # When the next clock tick is due (time.time() value)
+        self._clock_due = 0.0
+        # How late clock ticks run, for monitoring
+        self.clock_lateness = LatenessStats()
+        # True while the display is off and rendering is suspended
+        self._power_save = False
+        # The canvas everything is drawn on in compositor mode (otherwise None)
+        self.compositor = None
+        # Clock face drawn from a glyph atlas (None when the clock is drawn as text)
+        self._glyph_face = None
+        # When the first spinner load started (for startup profiling)
+        self._spinner_load_start = None
 
         # Screen dimensions
         self.screen_width = self.master.winfo_screenwidth()
@@ -81,11 +112,15 @@ class LumiClockApplication(tk.Frame):
         # This show set the display to full screen
         self.toggle_fullscreen()
 
-        self.context_menu = ContextMenu(self, height=self.screen_height)
+        with StartupProfiler.phase("menu build"):
+            self.context_menu = ContextMenu(self, height=self.screen_height)
 
         # Capture left mouse single click anywhere in the Frame
         self.bind("<Button-1>", self._show_context_menu)
 
+        # Pick up changes to the configuration file without a restart
+        self.after(self._config_poll_ms, self._watch_configuration)
+
     def _show_context_menu(self, event):
         if self._menu_showing:
             self.context_menu.unpost()
@@ -110,35 +145,153 @@ class LumiClockApplication(tk.Frame):
         Create clock and spinner widgets
         :return:
         """
-        # Define the clock widget and its font
+        self.debugfont = tkfont.Font(family='Helvetica', size=-20)
+        if QConfiguration.compositor:
+            self._create_canvas_items()
+        else:
+            self._create_label_widgets()
+
+        with StartupProfiler.phase("font build"):
+            self.change_font(QConfiguration.font)
+
+        # http://www.chimply.com/Generator#classic-spinner,animatedTriangles
+        # Select default spinner. It is decoded in the background so the
+        # clock face does not wait for it.
+        self._spinner_load_start = time.perf_counter()
+        self.image_label.load_async(QConfiguration.spinner, on_loaded=self._place_spinner)
+
+        self._create_debug_overlay()
+
+        # Start the clock
+        self.run_clock = True
+        self._clock_due = time.time()
+        self.debug_overlay.start()
+        self._update_clock()
+
+    def _create_label_widgets(self):
+        """
+        Create the clock, spinner and debug display as placed widgets
+        :return:
+        """
+        # Define the clock widget. Its font is set by change_font.
         self.textbox = tk.Label(self, text="12:00", fg=QConfiguration.color, bg='black')
-        self.change_font(QConfiguration.font)
         self.textbox.bind("<Button-1>", self._show_context_menu)
 
         # image display
         # animated GIF
         self.image_label = AnimatedGIFLabel(self, bg='black')
-        # http://www.chimply.com/Generator#classic-spinner,animatedTriangles
-        # Select default spinner
-        self.image_label.load(QConfiguration.spinner)
-        self.image_label.place(relx=1, x=-self.image_label.width, rely=0.5, anchor=tk.CENTER)
         self.image_label.bind("<Button-1>", self._show_context_menu)
 
         # Multi-line debug display at the bottom of the display
-        self.debugfont = tkfont.Font(family='Helvetica', size=-20)
         self.debug_display = tk.Label(self, text="", font=self.debugfont,
                                       fg=QConfiguration.color, bg='black',
                                       anchor=tk.W, justify=tk.LEFT)
+        self.debug_display.place(x=10,
+                                 rely=1.0,
+                                 y=self._debug_offset())
+
+    def _create_canvas_items(self):
+        """
+        Create the clock, spinner and debug display as items on one canvas
+        :return:
+        """
+        self.compositor = Compositor(self)
+        self.compositor.place(x=0, y=0, relwidth=1.0, relheight=1.0)
+        self.compositor.bind("<Button-1>", self._show_context_menu)
+
+        # The clock is drawn either as text or as a glyph atlas image.
+        # change_font shows one and hides the other.
+        self._clock_text_item = self.compositor.create_text(0, 0, anchor=tk.W, text="12:00",
+                                                            fill=QConfiguration.color)
+        self._clock_image_item = self.compositor.create_image(0, 0, anchor=tk.W, state=tk.HIDDEN)
+
+        self.image_label = CanvasGIFItem(self.compositor)
+
+        self._debug_item = self.compositor.create_text(10, self.screen_height + self._debug_offset(),
+                                                       anchor=tk.NW, justify=tk.LEFT, text="",
+                                                       font=self.debugfont, fill=QConfiguration.color)
+
+    def _create_debug_overlay(self):
+        """
+        Set up the fields of the debug display
+        :return:
+        """
+        self.debug_overlay = DebugOverlay(self, self._show_debug_text, refresh_ms=self._debug_refresh_ms)
+        overlay = self.debug_overlay
+        overlay.add_field(0, lambda: int(time.time()),
+                          lambda t: "Time: {0}".format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t))))
+        overlay.add_field(0, lambda: int(round(self.clock_lateness.last)),
+                          lambda ms: "Tick lateness: {0}ms".format(ms))
+        overlay.add_field(0, lambda: int(round(self.image_label.frame_lateness.average)),
+                          lambda ms: "Frame lateness: {0}ms".format(ms))
+        if self.compositor is not None:
+            overlay.add_field(0, lambda: int(round(self.compositor.redraws.rate)),
+                              lambda n: "Redraws: {0}/s".format(n))
+        if TkInstrumentation.installed:
+            overlay.add_field(0, self._slowest_callback,
+                              lambda s: "Slowest: {0} {1}ms".format(s[0], s[1]))
+        overlay.add_field(1, self._display.get_display_state,
+                          lambda state: "Display: {0}".format(state))
+        if self._sensor:
+            overlay.add_field(1, lambda: self._sensor.sensor_value,
+                              lambda v: "PIR Sensor: {0}".format(v))
+            overlay.add_field(1, lambda: self._sensor.off_counter,
+                              lambda n: "Off Counter: {0}".format(n))
+            overlay.add_field(1, lambda: self._sensor.on_counter,
+                              lambda n: "On Counter: {0}".format(n))
+
+    @staticmethod
+    def _slowest_callback():
+        """
+        :return: (name, longest run in ms) of the slowest Tk callback or None
+        """
+        slowest = TkInstrumentation.slowest()
+        if slowest is None:
+            return None
+        return slowest.name.split(".<locals>")[0], int(round(slowest.run_time.max / 1000.0))
+
+    @property
+    def glyph_blits(self):
+        """
+        Glyph images copied into the clock face. Safe to read from any thread.
+        :return: The count or None if the clock is not drawn from a glyph atlas
+        """
+        # Read once. A font change replaces the face on the Tk thread.
+        face = self._glyph_face
+        return face.blits if face is not None else None
+
+    def _show_debug_text(self, text):
+        """
+        Put new text on the debug display
+        :param text: The debug display text
+        :return:
+        """
+        if self.compositor is not None:
+            self.compositor.update_item(self._debug_item, text=text)
+        else:
+            self.debug_display["text"] = text
+
+    def _debug_offset(self):
+        """
+        :return: Position of the debug display relative to the bottom of the screen
+        """
         # Note that the font size is a negative number (of pixels).
         # The 1.5 multiplier provides for a line spacing half the size of the font.
         font_size = self.debugfont['size']
-        self.debug_display.place(x=10,
-                                 rely=1.0,
-                                 y=int(font_size * 1.5 * self._debug_lines))
+        return int(font_size * 1.5 * self._debug_lines)
 
-        # Start the clock
-        self.run_clock = True
-        self._update_clock()
+    def _place_spinner(self):
+        """
+        Position the spinner once its size is known
+        :return:
+        """
+        if self._spinner_load_start is not None:
+            StartupProfiler.record("GIF decode", time.perf_counter() - self._spinner_load_start)
+            self._spinner_load_start = None
+        if self.compositor is not None:
+            self.image_label.place_at(self.screen_width - self.image_label.width, int(self.screen_height / 2))
+        else:
+            self.image_label.place(relx=1, x=-self.image_label.width, rely=0.5, anchor=tk.CENTER)
 
     def _update_clock(self):
         """
@@ -146,8 +299,18 @@ class LumiClockApplication(tk.Frame):
         :return:
         """
         if self.run_clock:
+            if self._check_power_save():
+                return
+
+            # Measure how late this tick is. A tick is never allowed to display
+            # a time before the second it was scheduled for.
+            tick_time = time.time()
+            lateness = tick_time - self._clock_due
+            self.clock_lateness.record(lateness * 1000.0, skipped=max(0, int(lateness)))
+            tick_time = max(tick_time, self._clock_due - (self._tick_guard_ms / 1000.0))
+
             # Update the time display
-            now = datetime.datetime.now()
+            now = datetime.datetime.fromtimestamp(tick_time)
             current = now.strftime("%I:%M")
             if now.hour >= 12:
                 if (now.second % 2) == 0:
@@ -160,22 +323,106 @@ class LumiClockApplication(tk.Frame):
             if current[0] == '0':
                 current = current[1:]
             if self.last_time != current:
-                # How to change the label in code
-                self.textbox["text"] = current
+                if self._glyph_face is not None:
+                    self._glyph_face.set_text(current)
+                    if self.compositor is not None:
+                        self.compositor.image_changed()
+                elif self.compositor is not None:
+                    self.compositor.update_item(self._clock_text_item, text=current)
+                else:
+                    # How to change the label in code
+                    self.textbox["text"] = current
                 self.last_time = current
 
-            # Update debug display
-            dd = ""
-            if QConfiguration.debugdisplay:
-                dd = "Time: {0}".format(now.strftime("%Y-%m-%d %H:%M:%S"))
-                dd += "\nDisplay: {0}".format(self._display.get_display_state())
-                if self._sensor:
-                    dd += " | PIR Sensor: {0}".format(self._sensor.sensor_value)
-                    dd += " | Off Counter: {0}".format(self._sensor.off_counter)
-                    dd += " | On Counter: {0}".format(self._sensor.on_counter)
-            self.debug_display["text"] = dd
+            self._schedule_clock_tick()
 
-            self.after(1000, self._update_clock)
+    def _check_power_save(self):
+        """
+        Suspend all rendering while the display is off. While suspended,
+        the display state is polled without drawing anything. When the
+        display comes back on, the spinner restarts and the clock is redrawn
+        and realigned on the same tick.
+        :return: True if the display is off and nothing should be drawn
+        """
+        display_off = QConfiguration.powersave and self._display.get_display_state() == "off"
+        if display_off:
+            if not self._power_save:
+                self._power_save = True
+                self.image_label.pause()
+                self.debug_overlay.pause()
+                logger.debug("Display is off, power save started")
+            self.after(self._idle_poll_ms, self._update_clock)
+            return True
+
+        if self._power_save:
+            self._power_save = False
+            self.image_label.resume()
+            self.debug_overlay.resume()
+            # The wake up tick is not late, it is unscheduled
+            self._clock_due = time.time()
+            logger.debug("Display is on, power save ended")
+        return False
+
+    def _schedule_clock_tick(self):
+        """
+        Schedule the next clock tick just after the next wall clock second boundary.
+        Each tick is aligned independently, so there is no accumulated drift.
+        :return:
+        """
+        now = time.time()
+        self._clock_due = math.floor(now) + 1.0 + (self._tick_guard_ms / 1000.0)
+        self.after(int((self._clock_due - now) * 1000), self._update_clock)
+
+    def _watch_configuration(self):
+        """
+        Check the configuration file for changes (a stat call, unless
+        it changed) and apply whatever changed
+        :return:
+        """
+        if not self.run_clock:
+            return
+        changes = QConfiguration.reload()
+        if changes:
+            self.apply_configuration_changes(changes)
+        self.after(self._config_poll_ms, self._watch_configuration)
+
+    def apply_configuration_changes(self, changes):
+        """
+        Apply changed configuration settings to the running clock.
+        Only the parts affected by a change are updated.
+        :param changes: Dict of changed settings (see QConfiguration.reload)
+        :return: None
+        """
+        if "fontsize" in changes:
+            if QConfiguration.fontsize:
+                self.font_size = QConfiguration.fontsize
+            else:
+                self.font_size = int(0.45 * self.screen_height)
+        if "font" in changes or "fontsize" in changes or "glyphatlas" in changes or \
+                ("color" in changes and self._glyph_face is not None):
+            # The glyph atlas is rendered in the clock color
+            self.change_font(QConfiguration.font)
+        if "color" in changes:
+            if self.compositor is not None:
+                self.compositor.update_item(self._clock_text_item, fill=QConfiguration.color)
+                self.compositor.update_item(self._debug_item, fill=QConfiguration.color)
+            else:
+                self.textbox.config(fg=QConfiguration.color)
+                self.debug_display.config(fg=QConfiguration.color)
+        if "spinner" in changes:
+            self.change_spinner(QConfiguration.spinner)
+        if "backlight" in changes:
+            DisplayController.set_display_backlight(int(QConfiguration.backlight))
+        if ("timeout" in changes or "timein" in changes) and self._sensor:
+            self._sensor.set_timeouts(QConfiguration.timeout, QConfiguration.timein)
+
+        # These are only used at startup
+        restart = [k for k in changes if k in ["pirsensor", "pirpin", "pirmode", "backlightbackend",
+                                               "backlightroot", "logbuffer", "logflushinterval",
+                                               "compositor", "instrumentation", "instrumentationreport",
+                                               "statusport"]]
+        if restart:
+            logger.info("Configuration changes that take effect after a restart: %s", restart)
 
     def change_spinner(self, gif):
         """
@@ -183,8 +430,8 @@ class LumiClockApplication(tk.Frame):
         :param gif:
         :return:
         """
-        self.image_label.unload()
-        self.image_label.load(gif)
+        # The current spinner keeps running until the new one is decoded
+        self.image_label.load_async(gif, on_loaded=self._place_spinner)
         logger.debug("Spinner changed: %s", gif)
 
     def change_font(self, font_name):
@@ -195,16 +442,27 @@ class LumiClockApplication(tk.Frame):
         :return: None.
         """
         self.clockfont = tkfont.Font(family=font_name, size=self.font_size)
-        self.textbox.config(font=self.clockfont)
-
-        # Pick the largest of the size and linespace in an effort to keep
-        # the y offset small.
-        # The Digital 7 fonts have negative descent values. This throws
-        # positioning out of whack. To compensate, the absolute values
-        # for ascent and descent are used to calculate the practical linespace.
-        linespace = abs(self.clockfont.metrics()["ascent"]) + abs(self.clockfont.metrics()["descent"])
-        actual_size = max(self.clockfont.actual()["size"], linespace)
-        self.textbox.place(x=0, y=int((self.screen_height - actual_size) / 2), height=actual_size)
+        self._glyph_face = None
+        if QConfiguration.glyphatlas:
+            # Render the clock characters once for this font, size and color
+            self._glyph_face = GlyphClockFace.create(font_name, self._font_pixels(), QConfiguration.color)
+
+        if self._glyph_face is not None:
+            self._glyph_face.set_text(self.last_time or "12:00")
+            linespace = self._glyph_face.height
+            actual_size = linespace
+        else:
+            # Pick the largest of the size and linespace in an effort to keep
+            # the y offset small.
+            # The Digital 7 fonts have negative descent values. This throws
+            # positioning out of whack. To compensate, the absolute values
+            # for ascent and descent are used to calculate the practical linespace.
+            linespace = abs(self.clockfont.metrics()["ascent"]) + abs(self.clockfont.metrics()["descent"])
+            actual_size = max(self.clockfont.actual()["size"], linespace)
+        if self.compositor is not None:
+            self._show_clock_item()
+        else:
+            self._show_clock_label(actual_size)
 
         logger.debug("Font changed to: %s", font_name)
         logger.debug(self.clockfont.actual())
@@ -213,6 +471,47 @@ class LumiClockApplication(tk.Frame):
         logger.debug("Calculated linespace: %d", linespace)
         logger.debug("Clock widget y = %d", int((self.screen_height - actual_size) / 2))
 
+    def _show_clock_label(self, actual_size):
+        """
+        Put the current clock font or glyph face on the clock widget
+        :param actual_size: Height of the clock text in pixels
+        :return: None
+        """
+        if self._glyph_face is not None:
+            self.textbox.config(image=self._glyph_face.image)
+        else:
+            self.textbox.config(font=self.clockfont, image="")
+            if self.last_time:
+                self.textbox["text"] = self.last_time
+        self.textbox.place(x=0, y=int((self.screen_height - actual_size) / 2), height=actual_size)
+
+    def _show_clock_item(self):
+        """
+        Put the current clock font or glyph face on the canvas. The clock
+        is vertically centered like the clock widget.
+        :return: None
+        """
+        y = int(self.screen_height / 2)
+        if self._glyph_face is not None:
+            shown, hidden = self._clock_image_item, self._clock_text_item
+            self.compositor.update_item(shown, image=self._glyph_face.image, state=tk.NORMAL)
+        else:
+            shown, hidden = self._clock_text_item, self._clock_image_item
+            self.compositor.update_item(shown, font=self.clockfont, text=self.last_time or "12:00",
+                                        state=tk.NORMAL)
+        self.compositor.update_item(hidden, state=tk.HIDDEN)
+        self.compositor.move_item(shown, 0, y)
+
+    def _font_pixels(self):
+        """
+        The clock font size in pixels. Tk font sizes are in points
+        unless they are negative (pixels).
+        :return: Size in pixels
+        """
+        if self.font_size < 0:
+            return -self.font_size
+        return int(round(self.winfo_fpixels("{0}p".format(self.font_size))))
+
     def larger_font(self):
         font_name = self.clockfont.actual()["family"]
         self.font_size = int(self.font_size * 1.1)
@@ -228,7 +527,8 @@ class LumiClockApplication(tk.Frame):
 
 class SpinnerMenu(tk.Menu):
     """
-    Menu containing a list of all available spinner GIFs
+    Menu containing a list of all available spinner GIFs.
+    The menu items are created the first time the menu is posted.
     """
     def __init__(self, parent, command=None, height=20, **args):
         """
@@ -239,22 +539,31 @@ class SpinnerMenu(tk.Menu):
         """
         tk.Menu.__init__(self, parent, tearoff=0, **args)
         self.parent = parent
+        self._command = command
+        self._height = height
+        self._populated = False
+        self.config(postcommand=self._populate)
+
+    def _populate(self):
+        if self._populated:
+            return
+        self._populated = True
 
         menu_font = tkfont.Font(family="", size=11)
-        line_height = menu_font.metrics("linespace") + menu_font.metrics("ascent") + menu_font.metrics("descent")
-        max_menu_count = int(height / line_height)
 
         # Create a context menu item for each available GIF
         gifs = glob.glob("*.gif")
         gifs.sort()
         for g in gifs:
             # This is the best way I could find to pass the GIF name to the handler
-            self.add_command(label=g, font=menu_font, command=partial(command, g))
+            self.add_command(label=g, font=menu_font, command=partial(self._command, g))
+        logger.debug("Spinner menu built: %d spinners", len(gifs))
 
 
 class FontMenu(tk.Menu):
     """
-    Menu containing a list of all available fonts
+    Menu containing a list of all available fonts.
+    The menu items are created the first time the menu is posted.
     """
     def __init__(self, parent, command=None, height=20, **args):
         """
@@ -265,21 +574,30 @@ class FontMenu(tk.Menu):
         """
         tk.Menu.__init__(self, parent, tearoff=0, **args)
         self.parent = parent
+        self._command = command
+        self._height = height
+        self._populated = False
+        self.config(postcommand=self._populate)
+
+    def _populate(self):
+        if self._populated:
+            return
+        self._populated = True
 
         menu_font = tkfont.Font(family="", size=11)
         line_height = menu_font.metrics("linespace") + menu_font.metrics("ascent") + menu_font.metrics("descent")
-        max_menu_count = int(height / line_height)
+        max_menu_count = int(self._height / line_height)
 
-        fonts = list(tkfont.families())
-        fonts.sort()
+        fonts = FontFamilyCache.families(self)
         count = max_menu_count
         for item in fonts:
             if count <= 0:
-                self.add_command(label=item, font=menu_font, command=partial(command, item), columnbreak=True)
+                self.add_command(label=item, font=menu_font, command=partial(self._command, item), columnbreak=True)
                 count = max_menu_count
             else:
-                self.add_command(label=item, font=menu_font, command=partial(command, item))
+                self.add_command(label=item, font=menu_font, command=partial(self._command, item))
             count -= 1
+        logger.debug("Font menu built: %d fonts", len(fonts))
 
 class ContextMenu(tk.Menu):
     """
@@ -303,6 +621,7 @@ class ContextMenu(tk.Menu):
         self.add_command(label="Toggle fullscreen", command=self._toggle_fullscreen, font=menu_font)
         self.add_separator()
         self.add_command(label="Toggle Debug display", command=self._toggle_debug_display, font=menu_font)
+        self.add_command(label="Dump log buffer", command=self._dump_log_buffer, font=menu_font)
         self.add_separator()
         self.add_command(label="Save configuration", command=self._save_configuration, font=menu_font)
         self.add_separator()
@@ -323,16 +642,20 @@ class ContextMenu(tk.Menu):
         """
         self.parent.change_spinner(gif)
         QConfiguration.spinner = gif
+        QConfiguration.setting_changed()
 
     def _new_font(self, font_name):
         self.parent.change_font(font_name)
         QConfiguration.font = font_name
+        QConfiguration.setting_changed()
 
     def _larger_font(self):
         QConfiguration.fontsize = self.parent.larger_font()
+        QConfiguration.setting_changed()
 
     def _smaller_font(self):
         QConfiguration.fontsize = self.parent.smaller_font()
+        QConfiguration.setting_changed()
 
     def _save_configuration(self):
         QConfiguration.save()
@@ -340,6 +663,15 @@ class ContextMenu(tk.Menu):
 
     def _toggle_debug_display(self):
         QConfiguration.debugdisplay = not QConfiguration.debugdisplay
+        QConfiguration.setting_changed()
+        self.parent.debug_overlay.refresh()
+
+    def _dump_log_buffer(self):
+        dump_file = the_app_logger.dump_log_buffer()
+        if dump_file:
+            messagebox.showinfo("Dump Log Buffer", "Recent log lines written to {0}".format(dump_file))
+        else:
+            messagebox.showinfo("Dump Log Buffer", "The log ring buffer is not enabled")
 
     def _quit(self):
         """
@@ -18,8 +18,7 @@
 # it is not subject the behaviour of anything else like tkinter.
 #
 
-import RPi.GPIO as GPIO
-import time
+import math
 import threading
 from app_logger import AppLogger
 
@@ -46,26 +45,43 @@ class SensorThread(threading.Thread):
     _state_count_off = 3
     _state_count_on = 4
 
-    def __init__(self, pir_pin=12, name="PIRSensorThread", notify=None, time_off=300, time_on=2):
+    # Sensing modes
+    mode_poll = "poll"
+    mode_edge = "edge"
+
+    # In edge mode, how often (seconds) the sensor is read when no edge
+    # has been seen. This guards against a missed edge.
+    _edge_idle_timeout = 60.0
+
+    def __init__(self, pir_pin=12, name="PIRSensorThread", notify=None, time_off=300, time_on=2,
+                 mode="poll", gpio=None):
         """
         Class constructor.
         :param pir_pin: board pin number where PIR sensor data line is connected.
         :param name: A human readable name for the thread.
-        :param notify: Callback for handling sensor state. This method will
-        be called on the sensor thread, NOT the current thread.
+        :param notify: Callback for handling sensor state. It is called with the
+        initial debounced value and then only when the debounced value changes.
+        This method will be called on the sensor thread, NOT the current thread.
         :param time_off: The count down value for going to the off state
         :param time_on: The counte down value for going to the on state
+        :param mode: "poll" reads the sensor once a second. "edge" waits for the
+        sensor to change and runs the count downs from timestamps.
+        :param gpio: The GPIO backend (see gpio_backend.py). The default
+        is the Raspberry Pi's GPIO pins.
         """
         threading.Thread.__init__(self, name=name)
+        if gpio is None:
+            from gpio_backend import RPiGPIOBackend
+            gpio = RPiGPIOBackend()
+        self._gpio = gpio
         # Using pin 12 (GPIO 18) for PIR sensor signal
         self.pir_pin = pir_pin
-        # Using board numbering as opposed to BCM numbering
-        GPIO.setmode(GPIO.BOARD)
-        # Using pin for input only
-        GPIO.setup(self.pir_pin, GPIO.IN)
+        self._gpio.setup_input(self.pir_pin)
 
         self._notify_proc = notify
         self._terminate_thread = False
+        # The last value given to notify (None until the first notification)
+        self._published_value = None
 
         # Public properties
         # The debounced sensor value (not necessarily the actual sensor value)
@@ -78,6 +94,24 @@ class SensorThread(threading.Thread):
         self._count_down_off = self._time_off
         self._count_down_on = self._time_on
 
+        # Edge mode. The count downs end at these monotonic clock times.
+        self._mode = mode
+        self._edge_event = threading.Event()
+        self._off_deadline = 0.0
+        self._on_deadline = 0.0
+
+    def set_timeouts(self, time_off, time_on):
+        """
+        Change the count down values. A count down that is already
+        running finishes with the old value.
+        :param time_off: The count down value for going to the off state
+        :param time_on: The count down value for going to the on state
+        :return: None
+        """
+        self._time_off = time_off
+        self._time_on = time_on
+        logger.debug("Sensor timeouts changed: off %d, on %d", time_off, time_on)
+
     def run(self):
         """
         Override to call the sensor monitoring code
@@ -95,6 +129,7 @@ class SensorThread(threading.Thread):
         # multi-threading issues as the variable is only
         # read on the sensor thread.
         self._terminate_thread = True
+        self._edge_event.set()
         self.join()
 
     def run_sensor(self):
@@ -102,30 +137,139 @@ class SensorThread(threading.Thread):
         Monitors the PIR sensor. Expects to be called on
         its own thread.
         """
+        if self._mode == self.mode_edge:
+            self.run_sensor_edge()
+            return
 
         try:
             while not self._terminate_thread:
                 # Update the current state of the PIR sensor.
                 self._update_sensor()
-
-                if self._notify_proc:
-                    self._notify_proc(self.sensor_value)
+                self._publish()
 
                 # This is why the sensor monitor runs on its own thread.
-                time.sleep(1.0)
+                self._gpio.sleep(1.0)
+            logger.debug("Sensor thread terminated")
+        except Exception as ex:
+            logger.error("PIR Sensor thread terminated by unhandled exception")
+            logger.error(ex)
+
+    def run_sensor_edge(self):
+        """
+        Monitors the PIR sensor using GPIO edge detection. The thread sleeps
+        until the sensor changes or a count down ends. Expects to be called on
+        its own thread.
+        """
+        try:
+            self._gpio.add_edge_callback(self.pir_pin, self._on_edge)
+            while not self._terminate_thread:
+                self._edge_event.clear()
+                self._update_sensor_edge(self._gpio.monotonic())
+                self._publish()
+
+                self._gpio.wait(self._edge_event, self._edge_timeout(self._gpio.monotonic()))
+            self._gpio.remove_edge_callback(self.pir_pin)
             logger.debug("Sensor thread terminated")
         except Exception as ex:
             logger.error("PIR Sensor thread terminated by unhandled exception")
             logger.error(ex)
 
+    def _publish(self):
+        """
+        Notify the listener when the debounced sensor value changes
+        :return: None
+        """
+        if self._notify_proc and self.sensor_value != self._published_value:
+            self._published_value = self.sensor_value
+            self._notify_proc(self.sensor_value)
+
+    def _on_edge(self, channel):
+        """
+        GPIO event callback. This runs on the GPIO library's thread,
+        so it only wakes up the sensor thread.
+        :param channel: The pin that changed
+        :return: None
+        """
+        self._edge_event.set()
+
+    def _edge_timeout(self, now):
+        """
+        How long the sensor thread can sleep when waiting for an edge
+        :param now: The current monotonic clock time
+        :return: Timeout in seconds
+        """
+        if self._sensor_state == self._state_count_on:
+            return max(0.0, self._on_deadline - now)
+        if self._sensor_state == self._state_count_off:
+            return max(0.0, self._off_deadline - now)
+        return self._edge_idle_timeout
+
     @property
     def off_counter(self):
+        if self._mode == self.mode_edge and self._sensor_state == self._state_count_off:
+            return max(0, math.ceil(self._off_deadline - self._gpio.monotonic()))
         return self._count_down_off
 
     @property
     def on_counter(self):
+        if self._mode == self.mode_edge and self._sensor_state == self._state_count_on:
+            return max(0, math.ceil(self._on_deadline - self._gpio.monotonic()))
         return self._count_down_on
 
+    def _update_sensor_edge(self, now):
+        """
+        The edge mode version of the sensor state machine. It makes the same
+        transitions as _update_sensor, but the count downs end at a
+        deadline instead of after a number of one second ticks.
+        :param now: The current monotonic clock time
+        :return: The debounced value of the sensor, true or false.
+        """
+        actual_sensor_value = self._gpio.input(self.pir_pin)
+        logger.debug("Actual sensor: %d", actual_sensor_value)
+
+        # A count down that ends can lead directly to another transition
+        # (e.g. on -> count down to off) so run until the state is stable.
+        while True:
+            state = self._sensor_state
+            if state == self._state_init:
+                if actual_sensor_value:
+                    self._sensor_state = self._state_on
+                    self.sensor_value = True
+                else:
+                    self._sensor_state = self._state_off
+                    self.sensor_value = False
+            elif state == self._state_on:
+                if not actual_sensor_value:
+                    # New state is counting down to off
+                    self._sensor_state = self._state_count_off
+                    self._count_down_off = self._time_off
+                    self._off_deadline = now + self._time_off
+            elif state == self._state_off:
+                if actual_sensor_value:
+                    # New state is count down to on
+                    self._sensor_state = self._state_count_on
+                    self._count_down_on = self._time_on
+                    self._on_deadline = now + self._time_on
+            elif state == self._state_count_on:
+                # Like the polled state machine, the count down to on runs to the end
+                if now >= self._on_deadline:
+                    self._sensor_state = self._state_on
+                    self._count_down_on = 0
+                    self.sensor_value = True
+            elif state == self._state_count_off:
+                if actual_sensor_value:
+                    # New state is on
+                    self._sensor_state = self._state_on
+                elif now >= self._off_deadline:
+                    # New state is off
+                    self._sensor_state = self._state_off
+                    self._count_down_off = 0
+                    self.sensor_value = False
+            if state == self._sensor_state:
+                break
+
+        return self.sensor_value
+
     def _update_sensor(self):
         """
         Update the sensor state machine based on the current value of the sensor.
@@ -136,7 +280,7 @@ class SensorThread(threading.Thread):
         # Read the actual state of the PIR sensor.
         # 0 = no movement detected
         # 1 = movement detected
-        actual_sensor_value = GPIO.input(self.pir_pin)
+        actual_sensor_value = self._gpio.input(self.pir_pin)
         logger.debug("Actual sensor: %d", actual_sensor_value)
 
         # This is the state machine
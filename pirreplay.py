@@ -0,0 +1,127 @@
+# -*- coding: UTF-8 -*-
+#
+# Replay a recorded PIR sensor trace through the sensor thread
+# and the display state machine
+# Copyright © 2018, 2019  Dave Hocker (email: athomex10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Usage
+#   python pirreplay.py trace.csv [--timeout 600] [--timein 10] [--mode poll|edge]
+#   python pirreplay.py trace.csv --record 3600
+# The trace file format is described in gpio_backend.py.
+# --record samples the real sensor once a second for the given number
+# of seconds and writes the changes to the trace file.
+#
+
+import argparse
+import time
+from gpio_backend import SimulatedGPIOBackend
+from pir_sensor_thread import SensorThread
+from display_controller import DisplayController
+from app_logger import AppLogger
+
+# Logger init
+the_app_logger = AppLogger("lumiclock")
+logger = the_app_logger.getAppLogger()
+
+
+class ReplayDisplayController(DisplayController):
+    """
+    Runs the display state machine, but records the display
+    transitions instead of driving the display.
+    """
+    def __init__(self, gpio):
+        # The base class constructor is not called because it probes the display
+        self._gpio = gpio
+        self._display_state = self._state_display_on
+        self.transitions = []
+
+    def display_on(self):
+        self.transitions.append((self._gpio.monotonic(), True))
+
+    def display_off(self):
+        self.transitions.append((self._gpio.monotonic(), False))
+
+
+def record(trace_file, seconds, pir_pin):
+    from gpio_backend import RPiGPIOBackend
+    gpio = RPiGPIOBackend()
+    gpio.setup_input(pir_pin)
+    start = time.monotonic()
+    last_v = None
+    with open(trace_file, "w") as tf:
+        tf.write("# PIR sensor trace recorded {0}\n".format(time.strftime("%Y-%m-%d %H:%M:%S")))
+        while (time.monotonic() - start) < seconds:
+            v = gpio.input(pir_pin)
+            if v != last_v:
+                tf.write("{0:.1f},{1}\n".format(time.monotonic() - start, v))
+                tf.flush()
+                last_v = v
+            time.sleep(1.0)
+
+
+def replay(trace_file, time_off, time_on, mode):
+    trace = SimulatedGPIOBackend.load_trace(trace_file)
+    gpio = SimulatedGPIOBackend(trace)
+    display = ReplayDisplayController(gpio)
+    sensor = SensorThread(notify=display.set_display_state, time_off=time_off, time_on=time_on,
+                          mode=mode, gpio=gpio)
+
+    start = time.monotonic()
+    sensor.start()
+    gpio.finished.wait()
+    sensor.terminate()
+    elapsed = time.monotonic() - start
+
+    # Total time the display was on
+    on_time = 0.0
+    on_since = 0.0
+    for t, on in display.transitions:
+        if on:
+            on_since = t
+        elif on_since is not None:
+            on_time += t - on_since
+            on_since = None
+    if on_since is not None:
+        on_time += gpio.end_time - on_since
+
+    print("Trace: {0} changes over {1:.0f} seconds".format(len(trace), gpio.end_time))
+    print("Replayed in {0:.2f} seconds ({1} mode)".format(elapsed, mode))
+    print("Display transitions: {0}".format(len(display.transitions)))
+    print("Display on: {0:.0f} seconds ({1:.1f}%)".format(
+        on_time, (100.0 * on_time / gpio.end_time) if gpio.end_time else 0.0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a PIR sensor trace")
+    parser.add_argument("trace", help="Trace file")
+    parser.add_argument("--timeout", type=int, default=600, help="Display timeout in seconds")
+    parser.add_argument("--timein", type=int, default=10, help="Display timein in seconds")
+    parser.add_argument("--mode", default="poll", choices=["poll", "edge"], help="Sensor mode")
+    parser.add_argument("--record", type=int, default=0,
+                        help="Record the real sensor for this many seconds")
+    parser.add_argument("--pin", type=int, default=12, help="PIR sensor board pin")
+    args = parser.parse_args()
+
+    if args.record:
+        record(args.trace, args.record, args.pin)
+    else:
+        # One debug line per simulated second is too much
+        the_app_logger.set_log_level("info")
+        replay(args.trace, args.timeout, args.timein, args.mode)
+    the_app_logger.Shutdown()
+
+
+if __name__ == '__main__':
+    main()
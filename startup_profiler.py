@@ -0,0 +1,115 @@
+# -*- coding: UTF-8 -*-
+#
+# Startup time profiling
+# Copyright © 2018, 2019  Dave Hocker (email: athomex10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Enable with: python lumiclock.py --profile-startup
+# or by setting the LUMICLOCK_PROFILE_STARTUP environment variable.
+# The report is logged at info level once the first frame is on screen.
+#
+
+import time
+from app_logger import AppLogger
+
+
+# Logger init
+the_app_logger = AppLogger("lumiclock")
+logger = the_app_logger.getAppLogger()
+
+
+class _Phase:
+    """
+    Context manager that times one startup phase
+    """
+    def __init__(self, name):
+        self._name = name
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        StartupProfiler.record(self._name, time.perf_counter() - self._start)
+        return False
+
+
+class StartupProfiler:
+    """
+    Collects the time spent in each startup phase and the time to the first
+    frame. When profiling is not enabled, the methods do nothing.
+    """
+    enabled = False
+    _start = 0.0
+    _phases = []
+    _reported = False
+
+    @classmethod
+    def start(cls, start_time):
+        """
+        Turn on profiling
+        :param start_time: time.perf_counter() value when the app started
+        :return: None
+        """
+        cls.enabled = True
+        cls._start = start_time
+        cls._phases = []
+
+    @classmethod
+    def phase(cls, name):
+        """
+        Time a phase
+            with StartupProfiler.phase("config load"):
+                ...
+        :param name: Phase name
+        :return: A context manager
+        """
+        return _Phase(name)
+
+    @classmethod
+    def record(cls, name, seconds):
+        """
+        Record a phase that was timed elsewhere
+        :param name: Phase name
+        :param seconds: Time spent in the phase
+        :return: None
+        """
+        if cls.enabled:
+            cls._phases.append((name, seconds))
+            if cls._reported:
+                # Finished after the first frame (e.g. a background load)
+                logger.info("Startup: %-14s %8.1fms (after first frame)", name, seconds * 1000.0)
+
+    @classmethod
+    def elapsed(cls):
+        """
+        :return: Seconds since the app started
+        """
+        return time.perf_counter() - cls._start
+
+    @classmethod
+    def first_frame(cls):
+        """
+        Call when the first frame is on screen. Logs the report.
+        :return: None
+        """
+        if not cls.enabled or cls._reported:
+            return
+        cls._reported = True
+        total = cls.elapsed()
+        logger.info("Startup profile")
+        for name, seconds in cls._phases:
+            logger.info("Startup: %-14s %8.1fms", name, seconds * 1000.0)
+        logger.info("Startup: %-14s %8.1fms", "first frame", total * 1000.0)
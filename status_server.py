@@ -0,0 +1,172 @@
+# -*- coding: UTF-8 -*-
+#
+# Local status and metrics endpoint
+# Copyright © 2018, 2019  Dave Hocker (email: athomex10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# An HTTP server on localhost that serves the clock's status
+#   GET /status     JSON
+#   GET /metrics    Prometheus text format
+# For example: curl http://localhost:8765/metrics
+#
+# The server runs on its own thread. Each metric has a source function
+# that reads a counter or state attribute that another thread keeps up to
+# date. The sources never take a lock and never touch Tk, so serving a
+# request does not slow down the clock, the spinner or the sensor thread.
+#
+
+import os
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from app_logger import AppLogger
+
+
+# Logger init
+the_app_logger = AppLogger("lumiclock")
+logger = the_app_logger.getAppLogger()
+
+
+def process_memory():
+    """
+    Memory used by this process
+    :return: (resident bytes, peak resident bytes). Either can be None if
+    it is not available on this OS.
+    """
+    resident = None
+    peak = None
+    try:
+        with open("/proc/self/statm", "r") as sf:
+            resident = int(sf.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        # ru_maxrss is in KB on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except ImportError:
+        pass
+    return resident, peak
+
+
+class _StatusRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        status = self.server.status
+        path = self.path.split("?")[0]
+        if path in ["/", "/status"]:
+            body = json.dumps(status.snapshot(), indent=4, sort_keys=True)
+            content_type = "application/json"
+        elif path == "/metrics":
+            body = status.prometheus_text()
+            content_type = "text/plain; version=0.0.4"
+        else:
+            self.send_error(404)
+            return
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug("Status request from %s: %s", self.address_string(), format % args)
+
+
+class StatusServer(threading.Thread):
+    """
+    Serves registered metrics on localhost
+    """
+    def __init__(self, port, address="127.0.0.1"):
+        """
+        :param port: TCP port
+        :param address: Address to listen on. Keep this on the loopback
+        interface unless the status should be visible on the network.
+        """
+        threading.Thread.__init__(self, name="StatusServerThread", daemon=True)
+        self.port = port
+        self.address = address
+        self._metrics = []
+        self._server = None
+        self._start_time = time.monotonic()
+
+    def add_metric(self, name, help_text, source, metric_type="gauge"):
+        """
+        Register a metric
+        :param name: Metric name (lumiclock_ is added in Prometheus output)
+        :param help_text: One line description
+        :param source: Function that returns the current value: a number, a
+        string (a state) or None if the value is not available. It is called
+        on the server thread, so it must only read values.
+        :param metric_type: gauge or counter
+        :return: None
+        """
+        self._metrics.append((name, help_text, source, metric_type))
+
+    def snapshot(self):
+        """
+        Read every metric
+        :return: Dict of name: value
+        """
+        values = {"uptime_seconds": round(time.monotonic() - self._start_time, 1)}
+        for name, help_text, source, metric_type in self._metrics:
+            try:
+                value = source()
+            except Exception as ex:
+                logger.error("Status metric %s failed: %s", name, str(ex))
+                value = None
+            if value is not None:
+                values[name] = value
+        return values
+
+    def prometheus_text(self):
+        """
+        :return: The metrics in Prometheus text exposition format
+        """
+        values = self.snapshot()
+        lines = ["# HELP lumiclock_uptime_seconds Seconds since the clock started",
+                 "# TYPE lumiclock_uptime_seconds gauge",
+                 "lumiclock_uptime_seconds {0}".format(values["uptime_seconds"])]
+        for name, help_text, source, metric_type in self._metrics:
+            if name not in values:
+                continue
+            value = values[name]
+            lines.append("# HELP lumiclock_{0} {1}".format(name, help_text))
+            lines.append("# TYPE lumiclock_{0} {1}".format(name, metric_type))
+            if isinstance(value, str):
+                # States are exported as a label on a constant 1
+                lines.append('lumiclock_{0}{{state="{1}"}} 1'.format(name, value))
+            else:
+                lines.append("lumiclock_{0} {1}".format(name, value))
+        return "\n".join(lines) + "\n"
+
+    def run(self):
+        try:
+            self._server = ThreadingHTTPServer((self.address, self.port), _StatusRequestHandler)
+            self._server.daemon_threads = True
+            self._server.status = self
+        except Exception as ex:
+            logger.error("Unable to start status server on %s:%d", self.address, self.port)
+            logger.error(str(ex))
+            return
+        logger.info("Status server listening on http://%s:%d", self.address, self.port)
+        self._server.serve_forever()
+        self._server.server_close()
+        logger.debug("Status server terminated")
+
+    def terminate(self):
+        if self._server is not None:
+            self._server.shutdown()
+        self.join(timeout=5.0)
@@ -0,0 +1,151 @@
+# -*- coding: UTF-8 -*-
+#
+# Direct sysfs backlight control
+# Copyright © 2018, 2019  Dave Hocker (email: athomex10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# A backlight device is a directory under /sys/class/backlight, for example
+# /sys/class/backlight/10-0045 or /sys/class/backlight/rpi_backlight.
+# It contains these files.
+#   bl_power        0 = on, anything else = off
+#   brightness      0 to max_brightness
+#   max_brightness  read only
+#
+# The root directory can be any directory with the same layout. Use
+# create_fake_sysfs() to build one for testing on a machine without
+# a backlight.
+#
+
+import os
+import os.path
+from app_logger import AppLogger
+
+
+# Logger init
+the_app_logger = AppLogger("lumiclock")
+logger = the_app_logger.getAppLogger()
+
+
+class SysfsBacklight:
+    """
+    Backlight control through the sysfs files. It has the same power and
+    brightness properties as rpi_backlight.Backlight. The bl_power and brightness
+    files stay open, and writes that would not change a value are skipped.
+    Values are always read from the files because other programs (DPMS,
+    framebuffer blanking) can change them too.
+    """
+    default_root = "/sys/class/backlight"
+
+    def __init__(self, device_path):
+        """
+        :param device_path: The backlight device directory
+        """
+        self.device_path = device_path
+        with open(os.path.join(device_path, "max_brightness"), "r") as mf:
+            self.max_brightness = int(mf.read().strip())
+        self._power_fd = os.open(os.path.join(device_path, "bl_power"), os.O_RDWR)
+        self._brightness_fd = os.open(os.path.join(device_path, "brightness"), os.O_RDWR)
+        # A fake tree is made of regular files instead of sysfs attributes
+        self._regular_files = not os.path.realpath(device_path).startswith("/sys/")
+        # Counters for monitoring
+        self.writes = 0
+        self.skipped_writes = 0
+
+    @classmethod
+    def discover(cls, root=None):
+        """
+        Find the first backlight device under a sysfs backlight directory
+        :param root: The directory to search (defaults to /sys/class/backlight)
+        :return: A SysfsBacklight or None if there is no backlight device
+        """
+        if root is None:
+            root = cls.default_root
+        if not os.path.isdir(root):
+            return None
+        for name in sorted(os.listdir(root)):
+            device_path = os.path.join(root, name)
+            if all(os.path.exists(os.path.join(device_path, f))
+                   for f in ["bl_power", "brightness", "max_brightness"]):
+                try:
+                    backlight = cls(device_path)
+                    logger.debug("Found backlight device %s", device_path)
+                    return backlight
+                except Exception as ex:
+                    logger.error("Unable to open backlight device %s", device_path)
+                    logger.error(str(ex))
+        return None
+
+    @property
+    def power(self):
+        return self._read(self._power_fd) == 0
+
+    @power.setter
+    def power(self, on):
+        self._write(self._power_fd, 0 if on else 1)
+
+    @property
+    def brightness(self):
+        """
+        Brightness as a percentage (0-100)
+        """
+        return int(round((self._read(self._brightness_fd) * 100) / self.max_brightness))
+
+    @brightness.setter
+    def brightness(self, percent):
+        raw = int(round((percent * self.max_brightness) / 100))
+        self._write(self._brightness_fd, raw)
+
+    def close(self):
+        os.close(self._power_fd)
+        os.close(self._brightness_fd)
+
+    @staticmethod
+    def _read(fd):
+        return int(os.pread(fd, 32, 0).decode("ascii").strip())
+
+    def _write(self, fd, value):
+        """
+        Write a value unless it is already in the file
+        :return: None
+        """
+        if value == self._read(fd):
+            self.skipped_writes += 1
+            return
+        data = "{0}\n".format(value).encode("ascii")
+        os.pwrite(fd, data, 0)
+        if self._regular_files:
+            # Drop anything left from a longer previous value
+            # (sysfs attributes do not need this)
+            os.ftruncate(fd, len(data))
+        self.writes += 1
+
+
+def create_fake_sysfs(root, name="10-0045", max_brightness=255, power_on=True):
+    """
+    Build a fake sysfs backlight tree
+    :param root: Directory to use as the backlight root
+    :param name: Device name
+    :param max_brightness: Maximum raw brightness value
+    :param power_on: Initial power state
+    :return: The device directory
+    """
+    device_path = os.path.join(root, name)
+    if not os.path.exists(device_path):
+        os.makedirs(device_path)
+    for file_name, value in [("bl_power", 0 if power_on else 1),
+                             ("brightness", max_brightness),
+                             ("max_brightness", max_brightness)]:
+        with open(os.path.join(device_path, file_name), "w") as f:
+            f.write("{0}\n".format(value))
+    return device_path
@@ -0,0 +1,41 @@
+# -*- coding: UTF-8 -*-
+#
+# Test configuration
+# Copyright © 2018, 2019  Dave Hocker (email: athomex10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import glob
+import pytest
+
+# The modules live in the top level folder
+top_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, top_folder)
+
+from configuration import QConfiguration
+
+
+# The spinner GIFs that come with LumiClock
+bundled_gifs = sorted(glob.glob(os.path.join(top_folder, "*.gif")))
+
+
+@pytest.fixture
+def conf_folder(tmp_path, monkeypatch):
+    """
+    Use an empty configuration folder (and so an empty frame cache)
+    """
+    monkeypatch.setattr(QConfiguration, "file_path", str(tmp_path))
+    return tmp_path
@@ -0,0 +1,154 @@
+# -*- coding: UTF-8 -*-
+#
+# Tests for the spinner frame cache
+# Copyright © 2018, 2019  Dave Hocker (email: athomex10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os.path
+import random
+import pytest
+from PIL import Image
+from conftest import bundled_gifs
+from frame_cache import FrameSet, FrameCache
+
+
+def gif_frames(gif_path):
+    """
+    Decode a GIF with Pillow alone
+    :param gif_path: Path to the GIF file
+    :return: List of RGBA frame buffers
+    """
+    frames = []
+    with Image.open(gif_path) as im:
+        for i in range(im.n_frames):
+            im.seek(i)
+            frames.append(im.convert("RGBA").tobytes())
+    return frames
+
+
+@pytest.mark.parametrize("gif_path", bundled_gifs, ids=os.path.basename)
+def test_compact_frames_match_gif(gif_path):
+    with Image.open(gif_path) as im:
+        frameset = FrameSet.from_image(im)
+    expected = gif_frames(gif_path)
+    assert frameset.mode == "P"
+    assert len(frameset) == len(expected)
+    for i, frame in enumerate(expected):
+        assert frameset.image(i).tobytes() == frame, "frame {0}".format(i)
+
+
+@pytest.mark.parametrize("gif_path", bundled_gifs, ids=os.path.basename)
+def test_cache_round_trip(conf_folder, gif_path):
+    with Image.open(gif_path) as im:
+        frameset = FrameSet.from_image(im)
+    cache_file = FrameCache._cache_file(gif_path, frameset.size)
+    FrameCache.put(cache_file, frameset)
+
+    cached = FrameCache.get(cache_file)
+    assert cached is not None
+    try:
+        assert cached.size == frameset.size
+        assert cached.mode == frameset.mode
+        assert cached.palette == frameset.palette
+        assert cached.frame_map == frameset.frame_map
+        assert cached.durations == frameset.durations
+        assert cached.delay == frameset.delay
+        assert cached.deltas == frameset.deltas
+        assert len(cached.frames) == len(frameset.frames)
+        for stored, frame in zip(cached.frames, frameset.frames):
+            assert bytes(stored) == bytes(frame)
+    finally:
+        cached.close()
+
+
+def test_many_colors_are_kept_rgba():
+    rng = random.Random(1)
+    width, height = 31, 17
+    frames = [bytes(rng.randrange(256) for _ in range(width * height * 4)) for _ in range(3)]
+    frames.append(frames[0])
+    frameset = FrameSet.compact(width, height, frames)
+    assert frameset.mode == "RGBA"
+    assert frameset.frame_map == [0, 1, 2, 0]
+    for i, frame in enumerate(frames):
+        assert frameset.image(i).tobytes() == frame
+
+
+def test_palette_covers_all_colors():
+    # 256 colors (the most that fit a palette). Each red/green half and
+    # each blue/alpha half is shared by 16 colors.
+    rng = random.Random(2)
+    colors = [bytes((c % 16 * 17, 7, 0, c // 16 * 17)) for c in range(256)]
+    width, height = 32, 8
+    frames = [b"".join(colors)]
+    frames += [b"".join(rng.choice(colors) for _ in range(width * height)) for _ in range(4)]
+    frameset = FrameSet.compact(width, height, frames)
+    assert frameset.mode == "P"
+    assert len(frameset.palette) == 256 * 4
+    for i, frame in enumerate(frames):
+        assert frameset.image(i).tobytes() == frame
+
+
+def replay_changed_regions(frameset, seed):
+    """
+    Play a frame set the way delta updates do, skipping frames at random
+    (as a late animation does), and check the image after every step
+    :param frameset: The frames to play
+    :param seed: Seed for the frame skips
+    :return:
+    """
+    rng = random.Random(seed)
+    on_display = frameset.image(0).copy()
+    shown = 0
+    for _ in range(3 * len(frameset)):
+        index = (shown + rng.randint(1, 4)) % len(frameset)
+        box = frameset.changed_box(shown, index)
+        if box is not None:
+            # Without a mask, paste replaces the pixels, as Tk's "set" rule does
+            on_display.paste(frameset.image(index, box), box[:2])
+        shown = index
+        assert on_display.tobytes() == frameset.image(index).tobytes(), "frame {0}".format(index)
+
+
+@pytest.mark.parametrize("gif_path", bundled_gifs, ids=os.path.basename)
+def test_changed_regions_with_skipped_frames(conf_folder, gif_path):
+    with Image.open(gif_path) as im:
+        frameset = FrameSet.from_image(im)
+    replay_changed_regions(frameset, seed=3)
+
+    # The regions read back from the cache
+    cache_file = FrameCache._cache_file(gif_path, frameset.size)
+    FrameCache.put(cache_file, frameset)
+    cached = FrameCache.get(cache_file)
+    try:
+        replay_changed_regions(cached, seed=4)
+    finally:
+        cached.close()
+
+
+def test_changed_box_merges_skipped_frames():
+    width, height = 8, 4
+    frames = [bytearray(width * height * 4) for _ in range(4)]
+    # Frame 1 changes pixel (1, 1), frame 2 changes (6, 2), frame 3 repeats frame 2
+    frames[1][(1 * width + 1) * 4] = 255
+    for f in frames[2:]:
+        f[(1 * width + 1) * 4] = 255
+        f[(2 * width + 6) * 4] = 255
+    frameset = FrameSet.compact(width, height, [bytes(f) for f in frames])
+    assert frameset.changed_box(0, 1) == (1, 1, 2, 2)
+    assert frameset.changed_box(1, 2) == (6, 2, 7, 3)
+    assert frameset.changed_box(0, 2) == (1, 1, 7, 3)
+    assert frameset.changed_box(2, 3) is None
+    # Going from the last frame to the first undoes both changes
+    assert frameset.changed_box(3, 0) == (1, 1, 7, 3)
@@ -0,0 +1,154 @@
+# -*- coding: UTF-8 -*-
+#
+# Timing statistics for scheduled callbacks
+# Copyright © 2018, 2019  Dave Hocker (email: athomex10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import time
+
+
+class LatenessStats:
+    """
+    Tracks how late a recurring callback runs compared to when it was due.
+    All values are in milliseconds. The attributes are plain numbers so they
+    can be read from any thread without locking.
+    """
+    # Weight of the newest sample in the moving average
+    _alpha = 0.1
+
+    def __init__(self):
+        self.count = 0
+        self.last = 0.0
+        self.max = 0.0
+        self.average = 0.0
+        self.skipped = 0
+
+    def record(self, lateness_ms, skipped=0):
+        """
+        Record one run of the callback
+        :param lateness_ms: How late the callback ran (negative if early)
+        :param skipped: How many intervals were skipped to catch up
+        :return: None
+        """
+        self.count += 1
+        self.last = lateness_ms
+        self.max = max(self.max, lateness_ms)
+        if self.count == 1:
+            self.average = lateness_ms
+        else:
+            self.average += self._alpha * (lateness_ms - self.average)
+        self.skipped += skipped
+
+    def reset(self):
+        self.__init__()
+
+    def __str__(self):
+        return "last {0:.1f}ms avg {1:.1f}ms max {2:.1f}ms skipped {3}".format(
+            self.last, self.average, self.max, self.skipped)
+
+
+class RateCounter:
+    """
+    Counts events and reports how many happened per second. The rate is
+    measured over windows of at least one second, so it changes at most
+    once a second.
+    """
+    def __init__(self):
+        self.total = 0
+        self._rate = 0.0
+        self._window_start = time.monotonic()
+        self._window_count = 0
+
+    def count(self, n=1):
+        """
+        Record events
+        :param n: Number of events
+        :return: None
+        """
+        self._roll(time.monotonic())
+        self.total += n
+        self._window_count += n
+
+    @property
+    def rate(self):
+        """
+        Events per second in the last complete window
+        """
+        self._roll(time.monotonic())
+        return self._rate
+
+    def _roll(self, now):
+        elapsed = now - self._window_start
+        if elapsed >= 1.0:
+            self._rate = self._window_count / elapsed
+            self._window_start = now
+            self._window_count = 0
+
+    def reset(self):
+        self.__init__()
+
+    def __str__(self):
+        return "{0:.0f}/s".format(self.rate)
+
+
+class Log2Histogram:
+    """
+    Counts values in power of two buckets. Bucket 0 holds values below 1,
+    bucket n holds values from 2**(n-1) up to 2**n. Recording a value is
+    a few integer operations, so it can be used on hot paths.
+    """
+    def __init__(self, buckets=32):
+        self.counts = [0] * buckets
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        """
+        Count a value
+        :param value: The value (for example, a time in microseconds)
+        :return: None
+        """
+        bucket = int(value).bit_length() if value > 0 else 0
+        if bucket >= len(self.counts):
+            bucket = len(self.counts) - 1
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        """
+        The upper bound of the bucket that holds a percentile
+        :param p: Percentile (0-100)
+        :return: The bucket's upper bound (at most the largest value recorded)
+        """
+        if not self.count:
+            return 0.0
+        target = self.count * p / 100.0
+        running = 0
+        for bucket, n in enumerate(self.counts):
+            running += n
+            if running >= target:
+                return min(float(1 << bucket), self.max)
+        return self.max
+
+    def reset(self):
+        self.__init__(len(self.counts))
@@ -0,0 +1,199 @@
+# -*- coding: UTF-8 -*-
+#
+# Tk callback instrumentation
+# Copyright © 2018, 2019  Dave Hocker (email: athomex10@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Everything the clock does runs as a callback on the Tk thread, so one
+# slow callback delays all of the others. When instrumentation is installed,
+# every callback scheduled with after() or after_idle() and every menu
+# command is wrapped. The wrapper records the callback's run time and how
+# late it ran into log2 histograms (in microseconds).
+# The cost is two clock reads and a few integer operations per call, so it
+# can be left on in production.
+#
+
+import time
+import functools
+import tkinter as tk # In python2 it's Tkinter
+from timing_stats import Log2Histogram
+from app_logger import AppLogger
+
+
+# Logger init
+the_app_logger = AppLogger("lumiclock")
+logger = the_app_logger.getAppLogger()
+
+
+class CallbackStats:
+    """
+    Statistics for one callback. Times are in microseconds.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.run_time = Log2Histogram()
+        self.lateness = Log2Histogram()
+
+    def __str__(self):
+        return "{0}: calls {1} run avg {2:.2f}ms p99 {3:.2f}ms max {4:.2f}ms " \
+               "late avg {5:.2f}ms p99 {6:.2f}ms max {7:.2f}ms".format(
+                   self.name, self.calls,
+                   self.run_time.mean / 1000.0, self.run_time.percentile(99) / 1000.0,
+                   self.run_time.max / 1000.0,
+                   self.lateness.mean / 1000.0, self.lateness.percentile(99) / 1000.0,
+                   self.lateness.max / 1000.0)
+
+
+class TkInstrumentation:
+    """
+    Wraps Tk callbacks to measure them. Installing it patches tkinter's
+    after and Menu.add for every widget, and the statistics are kept per
+    callback name.
+    """
+    installed = False
+    stats = {}
+    _after = None
+    _menu_add = None
+    _report_after_id = None
+
+    @classmethod
+    def install(cls):
+        """
+        Start instrumenting callbacks. Must be called before the callbacks
+        are scheduled (before the Tk root is created).
+        :return: None
+        """
+        if cls.installed:
+            return
+        cls._after = tk.Misc.after
+        cls._menu_add = tk.Menu.add
+        tk.Misc.after = cls._instrumented_after
+        tk.Menu.add = cls._instrumented_menu_add
+        cls.installed = True
+        logger.info("Tk callback instrumentation installed")
+
+    @classmethod
+    def uninstall(cls):
+        """
+        Stop instrumenting callbacks scheduled from now on
+        :return: None
+        """
+        if not cls.installed:
+            return
+        tk.Misc.after = cls._after
+        tk.Menu.add = cls._menu_add
+        cls.installed = False
+
+    @staticmethod
+    def callback_name(func):
+        """
+        A readable name for a callback (e.g. LumiClockApplication._update_clock)
+        :param func: The callback
+        :return: Name
+        """
+        if isinstance(func, functools.partial):
+            func = func.func
+        func = getattr(func, "__func__", func)
+        return getattr(func, "__qualname__", None) or repr(func)
+
+    @classmethod
+    def _stats_for(cls, func):
+        name = cls.callback_name(func)
+        stats = cls.stats.get(name)
+        if stats is None:
+            stats = CallbackStats(name)
+            cls.stats[name] = stats
+        return stats
+
+    @classmethod
+    def _wrap(cls, func, due):
+        """
+        Wrap a callback
+        :param func: The callback
+        :param due: When the callback should run (time.perf_counter())
+        or None if it runs in response to an event
+        :return: The wrapped callback
+        """
+        stats = cls._stats_for(func)
+
+        def timed(*args):
+            start = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                end = time.perf_counter()
+                stats.calls += 1
+                stats.run_time.record((end - start) * 1000000.0)
+                if due is not None:
+                    stats.lateness.record(max(0.0, start - due) * 1000000.0)
+        return timed
+
+    # These replace the Tk methods, so self is the widget
+
+    def _instrumented_after(self, ms, func=None, *args):
+        if func is None:
+            # after(ms) is a sleep
+            return TkInstrumentation._after(self, ms)
+        # after_idle calls after("idle", ...). An idle callback is due now.
+        due = time.perf_counter()
+        if ms != "idle":
+            due += ms / 1000.0
+        return TkInstrumentation._after(self, ms, TkInstrumentation._wrap(func, due), *args)
+
+    def _instrumented_menu_add(self, itemType, cnf={}, **kw):
+        if callable(cnf.get("command")):
+            cnf = dict(cnf)
+            cnf["command"] = TkInstrumentation._wrap(cnf["command"], None)
+        if callable(kw.get("command")):
+            kw["command"] = TkInstrumentation._wrap(kw["command"], None)
+        return TkInstrumentation._menu_add(self, itemType, cnf, **kw)
+
+    @classmethod
+    def slowest(cls):
+        """
+        The callback with the longest run so far
+        :return: CallbackStats or None if nothing has been recorded
+        """
+        if not cls.stats:
+            return None
+        return max(cls.stats.values(), key=lambda s: s.run_time.max)
+
+    @classmethod
+    def log_summary(cls):
+        """
+        Log the statistics of every callback, the most time consuming first
+        :return: None
+        """
+        if not cls.stats:
+            return
+        logger.info("Tk callback summary")
+        for stats in sorted(cls.stats.values(), key=lambda s: s.run_time.total, reverse=True):
+            logger.info(str(stats))
+
+    @classmethod
+    def start_reporting(cls, widget, interval):
+        """
+        Log a summary periodically
+        :param widget: Any Tk widget (used to schedule the reports)
+        :param interval: Seconds between reports (0 = no periodic reports)
+        :return: None
+        """
+        if interval <= 0:
+            return
+
+        def report():
+            cls.log_summary()
+            cls._report_after_id = widget.after(int(interval * 1000), report)
+        cls._report_after_id = widget.after(int(interval * 1000), report)